@@ -0,0 +1,284 @@
+""" Collection of Bigquery jobs which write rows in bulk (instead of a DML statement per row) """
+
+import datetime
+import hashlib
+import itertools
+import json
+import uuid
+from typing import Callable
+
+from google.api_core.exceptions import Conflict, GoogleAPICallError
+from google.cloud import bigquery
+
+# Staging tables are deleted after use, the expiration only cleans up after crashed runs
+STAGING_TABLE_EXPIRATION = datetime.timedelta(days=1)
+
+# Limit of source URIs per load job
+MAX_URIS_PER_LOAD_JOB = 10000
+
+
+def stage_rows(
+    bigquery_client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    rows: list[dict],
+    schema: list[bigquery.SchemaField],
+) -> str:
+    """Load rows into a new, expiring staging table with a single load job and return its id"""
+
+    table_id = f"{bigquery_client.project}.{dataset_id}.{table_name}-staging-{uuid.uuid4().hex[:12]}"
+
+    table = bigquery.Table(table_id, schema=schema)
+    table.expires = (
+        datetime.datetime.now(datetime.timezone.utc) + STAGING_TABLE_EXPIRATION
+    )
+    bigquery_client.create_table(table)
+
+    job_config = bigquery.LoadJobConfig(
+        schema=schema,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    bigquery_client.load_table_from_json(rows, table_id, job_config=job_config).result()
+
+    return table_id
+
+
+def merge_rows(
+    bigquery_client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    rows: list[dict],
+    schema: list[bigquery.SchemaField],
+    merge_query: str,
+) -> int:
+    """Apply rows to a table with one `MERGE` and return the number of affected rows
+
+    The rows are staged with a load job (which doesn't count against DML quotas). `merge_query`
+    refers to the target table as `{target}` and to the staged rows as `{staging}`.
+    """
+
+    staging_table_id = stage_rows(bigquery_client, dataset_id, table_name, rows, schema)
+
+    try:
+        query = merge_query.format(
+            target=f"`{bigquery_client.project}.{dataset_id}.{table_name}`",
+            staging=f"`{staging_table_id}`",
+        )
+        query_job = bigquery_client.query(query)
+        query_job.result()
+    finally:
+        bigquery_client.delete_table(staging_table_id, not_found_ok=True)
+
+    return query_job.num_dml_affected_rows
+
+
+def load_job_id(table_name: str, rows: list, prefix: str = "load") -> str:
+    """Job id derived from the rows (or files), so loading the same batch twice is rejected by Bigquery"""
+    digest = hashlib.sha256(
+        json.dumps(rows, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    table_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in table_name)
+    return f"{prefix}-{table_name}-{digest[:32]}"
+
+
+def run_job(
+    bigquery_client: bigquery.Client,
+    submit: Callable[[str], bigquery.job._AsyncJob],
+    job_id: str,
+) -> bigquery.job._AsyncJob:
+    """Submit a job (load or query) with `submit(job_id)` unless one with this id succeeded already, and wait for it
+
+    A job which failed under this id (e.g. schema mismatch or quota) isn't awaited again, the job
+    is submitted under the next id (`<job_id>-1`, `<job_id>-2`, ...) instead.
+    """
+    for attempt in itertools.count():
+        attempt_job_id = job_id if attempt == 0 else f"{job_id}-{attempt}"
+        try:
+            load_job = submit(attempt_job_id)
+        except Conflict:
+            load_job = bigquery_client.get_job(attempt_job_id)
+            try:
+                load_job.result()
+            except GoogleAPICallError:
+                if load_job.error_result is None:
+                    raise
+                continue  # Failed before, submit again under the next id
+            return load_job
+
+        load_job.result()
+        return load_job
+
+
+def load_rows(
+    bigquery_client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    rows: list[dict],
+) -> int:
+    """Append rows to a table with a single load job and return the number of loaded rows
+
+    Load jobs have no per-row cost (unlike streaming inserts). The job id is derived from the
+    rows: if a retry sends a batch which has been committed already, the existing job is awaited
+    instead of loading the rows again (exactly once per batch, see `run_job`).
+    """
+
+    table_id = f"{bigquery_client.project}.{dataset_id}.{table_name}"
+    job_id = load_job_id(table_name, rows)
+    job_config = bigquery.LoadJobConfig(
+        # Rows are coerced into the schema of the table (like streaming inserts)
+        schema=bigquery_client.get_table(table_id).schema,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+
+    load_job = run_job(
+        bigquery_client,
+        lambda job_id: bigquery_client.load_table_from_json(
+            rows, table_id, job_id=job_id, job_config=job_config
+        ),
+        job_id,
+    )
+
+    return load_job.output_rows
+
+
+def stage_uris(
+    bigquery_client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    source_uris: list[str],
+    file_format: str = "PARQUET",
+    autodetect: bool = True,
+) -> str:
+    """Load files into a new, expiring staging table with a single load job and return its id"""
+
+    table_id = f"{bigquery_client.project}.{dataset_id}.{table_name}-staging-{uuid.uuid4().hex[:12]}"
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=file_format, autodetect=autodetect
+    )
+    bigquery_client.load_table_from_uri(
+        source_uris, table_id, job_config=job_config
+    ).result()
+
+    table = bigquery_client.get_table(table_id)
+    table.expires = (
+        datetime.datetime.now(datetime.timezone.utc) + STAGING_TABLE_EXPIRATION
+    )
+    bigquery_client.update_table(table, ["expires"])
+
+    return table_id
+
+
+def insert_projection(
+    bigquery_client: bigquery.Client,
+    table_id: str,
+    staging_table_id: str,
+    projection: str,
+    job_id: str,
+    partition_field: str = None,
+    clustering_fields: list[str] = None,
+) -> int:
+    """Insert the rows of a staging table, projected by a `SELECT` list, and return their number
+
+    A missing table is created with the columns of the projection, partitioned by month of
+    `partition_field` (a TIMESTAMP column of the projection) and clustered by `clustering_fields`.
+    The insert runs under `job_id` (see `run_job`), so a retried insert doesn't append twice.
+    """
+    partition_clause = (
+        f"PARTITION BY TIMESTAMP_TRUNC({partition_field}, MONTH)"
+        if partition_field
+        else ""
+    )
+    cluster_clause = (
+        f"CLUSTER BY {', '.join(clustering_fields)}" if clustering_fields else ""
+    )
+
+    bigquery_client.query(
+        f"""
+        CREATE TABLE IF NOT EXISTS `{table_id}`
+        {partition_clause}
+        {cluster_clause}
+        AS SELECT {projection} FROM `{staging_table_id}` LIMIT 0
+    """
+    ).result()
+
+    query_job = run_job(
+        bigquery_client,
+        lambda job_id: bigquery_client.query(
+            f"INSERT INTO `{table_id}` SELECT {projection} FROM `{staging_table_id}`",
+            job_id=job_id,
+        ),
+        job_id,
+    )
+
+    return query_job.num_dml_affected_rows
+
+
+def load_uris(
+    bigquery_client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    source_uris: list[str],
+    file_format: str = "PARQUET",
+    autodetect: bool = True,
+    partition_field: str = None,
+    clustering_fields: list[str] = None,
+    projection: str = None,
+) -> int:
+    """Append files of Google Cloud Storage to a native table and return the number of loaded rows
+
+    A missing table is created by the first load job, partitioned by month of `partition_field`
+    and clustered by `clustering_fields`. Like `load_rows` the job id is derived from the files,
+    so a retried load doesn't append them twice.
+
+    With a `projection` (`SELECT` list) the files are loaded into a staging table first and only
+    the projected columns are inserted, e.g. to lift nested fields to top level columns which the
+    table can be partitioned and clustered by.
+    """
+
+    table_id = f"{bigquery_client.project}.{dataset_id}.{table_name}"
+    job_config = bigquery.LoadJobConfig(
+        source_format=file_format,
+        autodetect=autodetect,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        clustering_fields=clustering_fields,
+    )
+    if partition_field is not None:
+        job_config.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.MONTH, field=partition_field
+        )
+
+    loaded_rows = 0
+    for i in range(0, len(source_uris), MAX_URIS_PER_LOAD_JOB):
+        uris = source_uris[i : i + MAX_URIS_PER_LOAD_JOB]
+
+        if projection is None:
+            load_job = run_job(
+                bigquery_client,
+                lambda job_id: bigquery_client.load_table_from_uri(
+                    uris, table_id, job_id=job_id, job_config=job_config
+                ),
+                load_job_id(table_name, uris),
+            )
+            loaded_rows += load_job.output_rows
+            continue
+
+        staging_table_id = stage_uris(
+            bigquery_client, dataset_id, table_name, uris, file_format, autodetect
+        )
+        try:
+            loaded_rows += insert_projection(
+                bigquery_client,
+                table_id,
+                staging_table_id,
+                projection,
+                load_job_id(table_name, uris, prefix="insert"),
+                partition_field,
+                clustering_fields,
+            )
+        finally:
+            bigquery_client.delete_table(staging_table_id, not_found_ok=True)
+
+    return loaded_rows
@@ -0,0 +1,55 @@
+""" Process wide cache of authenticated Google Cloud clients """
+
+import threading
+
+from google.cloud import storage
+from prefect_gcp import GcpCredentials
+
+_storage_clients = {}
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_storage_client(gcp_credential_block_name: str) -> storage.Client:
+    """Get the cached Cloud Storage client of a credentials block (loaded once per process)"""
+    with _lock:
+        if gcp_credential_block_name not in _storage_clients:
+            gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
+            _storage_clients[
+                gcp_credential_block_name
+            ] = gcp_credentials.get_cloud_storage_client()
+        return _storage_clients[gcp_credential_block_name]
+
+
+def get_bucket(bucket_name: str, gcp_credential_block_name: str) -> storage.Bucket:
+    """Get a cached bucket handle (no API request is made)"""
+    storage_client = get_storage_client(gcp_credential_block_name)
+
+    key = (gcp_credential_block_name, bucket_name)
+    with _lock:
+        if key not in _buckets:
+            _buckets[key] = storage_client.bucket(bucket_name)
+        return _buckets[key]
+
+
+def get_bigquery_read_client(gcp_credentials: GcpCredentials):
+    """Create a Bigquery Storage Read API client with the credentials of a block
+
+    Returns None if `google-cloud-bigquery-storage` (extra "bqstorage" of google-cloud-bigquery)
+    isn't installed.
+    """
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        return None
+
+    return bigquery_storage.BigQueryReadClient(
+        credentials=gcp_credentials.get_credentials_from_service_account()
+    )
+
+
+def clear_clients():
+    """Forget all cached clients (e.g. after credentials were rotated)"""
+    with _lock:
+        _storage_clients.clear()
+        _buckets.clear()
@@ -1,7 +1,17 @@
 """ Collection of Extraction functions """
 
-from google.cloud import storage
-from prefect_gcp import GcpCredentials
+import gzip
+import queue
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+import pyarrow as pa
+import zstandard
+from google.cloud import bigquery, storage
+
+from src.etl.clients import get_bucket, get_storage_client
 
 ########## GCP ##############
 
@@ -14,10 +24,7 @@ def download_blob_to_file(
 ) -> storage.bucket.Bucket.blob:
     """Downloads a blob from the bucket."""
 
-    gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
-    storage_client = gcp_credentials.get_cloud_storage_client()
-
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
 
     # Construct a client side representation of a blob.
     # Note `Bucket.blob` differs from `Bucket.get_blob` as it doesn't retrieve
@@ -29,21 +36,164 @@ def download_blob_to_file(
     return blob
 
 
+def decompress(contents: bytes, content_encoding: str = None) -> bytes:
+    """Decompress contents stored with `Content-Encoding` gzip or zstd (see `src.etl.load.compress`)"""
+    if not content_encoding or content_encoding == "identity":
+        return contents
+    if content_encoding == "gzip":
+        return gzip.decompress(contents)
+    if content_encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompress(contents)
+
+    raise ValueError(f"Content-Encoding '{content_encoding}' not supported")
+
+
 def download_blob_into_memory(
     bucket_name: str, blob_name: str, gcp_credential_block_name: str
 ) -> str:
-    """Downloads a blob into memory."""
+    """Downloads a blob into memory (decompressed according to its Content-Encoding)."""
 
-    gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
-    storage_client = gcp_credentials.get_cloud_storage_client()
-
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
 
     # Construct a client side representation of a blob.
     # Note `Bucket.blob` differs from `Bucket.get_blob` as it doesn't retrieve
     # any content from Google Cloud Storage. As we don't need additional data,
     # using `Bucket.blob` is preferred here.
     blob = bucket.blob(blob_name)
-    contents = blob.download_as_string()
+    # Raw download, so zstd (which GCS doesn't transcode) and gzip are decompressed the same way.
+    # The Content-Encoding is taken from the headers of the download.
+    contents = blob.download_as_string(raw_download=True)
+
+    return decompress(contents, blob.content_encoding)
+
+
+# Characters Unsplash photo ids (and thereby blob names) start with
+ID_ALPHABET = string.digits + string.ascii_letters + "-_"
+
+
+def list_blob_names(
+    bucket_name: str,
+    gcp_credential_block_name: str,
+    prefixes: list[str] = None,
+    delimiter: str = None,
+    page_size: int = 1000,
+    max_workers: int = 16,
+) -> Iterator[str]:
+    """List blob names of a bucket, with the keyspace split into `prefixes` which are listed concurrently.
+
+    Names are yielded as soon as a page of any prefix arrives and only the `name` field is
+    requested. By default the keyspace is split by the first character of photo ids.
+    """
+
+    storage_client = get_storage_client(gcp_credential_block_name)
+    prefixes = [c for c in ID_ALPHABET] if prefixes is None else prefixes
+
+    pages = queue.Queue(maxsize=4 * max_workers)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        """Hand an item to the consumer (give up once it stopped consuming)"""
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def list_prefix(prefix: str):
+        """List all blobs starting with `prefix` page by page"""
+        try:
+            blobs = storage_client.list_blobs(
+                bucket_name,
+                prefix=prefix,
+                delimiter=delimiter,
+                page_size=page_size,
+                fields="items(name),nextPageToken,prefixes",
+            )
+            for page in blobs.pages:
+                if stop.is_set():
+                    return
+                put([blob.name for blob in page])
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for prefix in prefixes:
+            executor.submit(list_prefix, prefix)
+
+        finished = 0
+        while finished < len(prefixes):
+            page = pages.get()
+            if page is done:
+                finished += 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+########## Bigquery ##############
+
+
+def pending_work_query(
+    source_table: str,
+    processed_table: str,
+    key_column: str,
+    columns: list[str],
+    order_by: str = None,
+    limit: bool = True,
+) -> str:
+    """Query rows of `source_table` whose key isn't in `processed_table` yet (anti-join in Bigquery)
+
+    Each key is returned once (the first by `order_by`), rows are sorted by `order_by` and with
+    `limit` only the first `@limit` (INT64 query parameter) rows are returned, so only the rows a
+    run will process leave Bigquery.
+    """
+    order_clause = f" ORDER BY {order_by}" if order_by else ""
+
+    query = f"""
+        SELECT {", ".join(columns)}
+        FROM `{source_table}` AS source
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM `{processed_table}` AS processed
+            WHERE processed.{key_column} = source.{key_column}
+        )
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY source.{key_column}{order_clause}) = 1
+        {order_clause.strip()}
+    """
+    if limit:
+        query += "    LIMIT @limit\n"
+
+    return query
+
+
+def query_record_batches(
+    bigquery_client: bigquery.Client,
+    query: str,
+    query_parameters: list = None,
+    page_size: int = 10000,
+    max_queue_size: int = 4,
+    bqstorage_client=None,
+) -> Iterator[pa.RecordBatch]:
+    """Run a query and stream its result as Arrow record batches (instead of a `Row` per row)
+
+    With a `bqstorage_client` (see `src.etl.clients.get_bigquery_read_client`) the result is read
+    through the Storage Read API in parallel streams, at most `max_queue_size` batches are
+    buffered. Otherwise the result is read page by page (`page_size` rows) through the REST API.
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    rows = bigquery_client.query(query, job_config=job_config).result(
+        page_size=page_size
+    )
 
-    return contents
+    yield from rows.to_arrow_iterable(
+        bqstorage_client=bqstorage_client, max_queue_size=max_queue_size
+    )
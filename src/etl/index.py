@@ -0,0 +1,125 @@
+""" Incremental index of known photo ids, persisted as compact blob next to the photos
+
+Instead of listing the whole bucket on every run, only manifests written after the last
+watermark are read. Manifest names sort by page (`manifest/page-0000042.csv`), so the name of the
+last read manifest is the watermark and GCS can skip everything before it (`start_offset`).
+Photos stored as single blobs before manifests existed are listed once, when the index is built.
+"""
+
+import gzip
+import json
+from pathlib import Path
+from typing import Callable
+
+from google.cloud.exceptions import NotFound
+
+from src.etl.extract import download_blob_into_memory, list_blob_names
+from src.etl.load import upload_blob_from_memory
+from src.etl.shards import is_photo_blob, list_manifest_blob_names, read_manifests
+
+INDEX_BLOB_NAME = "index/photo_ids.json.gz"
+
+
+class PhotoIdIndex:
+    """Photo ids stored in a bucket (`known`)
+
+    The index is stored as gzipped JSON (a few MB for hundreds of thousands of ids). Which photos
+    have been processed is kept by `src.etl.state`.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], bytes | None],
+        save: Callable[[bytes], None],
+    ):
+        self._load = load
+        self._save = save
+        contents = load()
+        self.exists = contents is not None
+        state = json.loads(gzip.decompress(contents)) if contents else {}
+        self.known = set(state.get("known", []))
+        self.manifest_watermark = state.get("manifest_watermark")
+
+    @classmethod
+    def from_file(cls, path: str) -> "PhotoIdIndex":
+        """Index stored in a local file"""
+        path = Path(path)
+
+        def load():
+            return path.read_bytes() if path.exists() else None
+
+        return cls(load, path.write_bytes)
+
+    @classmethod
+    def from_gcs_blob(
+        cls,
+        bucket_name: str,
+        gcp_credential_block_name: str,
+        blob_name: str = INDEX_BLOB_NAME,
+    ) -> "PhotoIdIndex":
+        """Index stored as blob in a Google Cloud Storage Bucket"""
+
+        def load():
+            try:
+                return download_blob_into_memory(
+                    bucket_name, blob_name, gcp_credential_block_name
+                )
+            except NotFound:
+                return None
+
+        def save(contents: bytes):
+            upload_blob_from_memory(
+                bucket_name,
+                contents,
+                blob_name,
+                gcp_credential_block_name,
+                content_type="application/gzip",
+            )
+
+        return cls(load, save)
+
+    def reset(self):
+        """Forget all ids, so the index is built from scratch"""
+        self.exists = False
+        self.known = set()
+        self.manifest_watermark = None
+
+    def update_from_bucket(
+        self, bucket_name: str, gcp_credential_block_name: str
+    ) -> int:
+        """Add the photo ids of manifests newer than the watermark and return the number of new ids
+
+        Without a watermark (new index) all photos stored as single blobs are listed as well.
+        The manifest at the watermark is read again, as it may have been overwritten since.
+        """
+        number_known = len(self.known)
+
+        if self.manifest_watermark is None:
+            self.known.update(
+                blob_name.split(".")[0]
+                for blob_name in list_blob_names(
+                    bucket_name, gcp_credential_block_name, delimiter="/"
+                )
+                if is_photo_blob(blob_name)
+            )
+
+        manifest_blob_names = list_manifest_blob_names(
+            bucket_name, gcp_credential_block_name, start_offset=self.manifest_watermark
+        )
+        manifest = read_manifests(
+            bucket_name, manifest_blob_names, gcp_credential_block_name
+        )
+        self.known.update(manifest.keys())
+        if manifest_blob_names:
+            self.manifest_watermark = max(manifest_blob_names)
+
+        return len(self.known) - number_known
+
+    def save(self):
+        """Persist the index"""
+        state = {
+            "manifest_watermark": self.manifest_watermark,
+            "known": sorted(self.known),
+        }
+        self._save(gzip.compress(json.dumps(state).encode("utf-8")))
+        self.exists = True
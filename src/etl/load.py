@@ -2,8 +2,59 @@
 
 ########## GCP ##############
 
+import base64
+import contextlib
+import gzip
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator
+
+import google_crc32c
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
 from google.cloud import storage
-from prefect_gcp import GcpCredentials
+from google.cloud.exceptions import NotFound
+from google.cloud.storage.fileio import BlobWriter
+from google.cloud.storage.retry import DEFAULT_RETRY
+
+from src.etl.clients import get_bucket
+from src.network.descriptors import descriptor_limiter
+
+# Chunk size of resumable uploads, has to be a multiple of 256 KiB
+RESUMABLE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Workers of bulk uploads, matches the connection pool of a storage client (more workers would
+# open and drop a new connection per request)
+BULK_UPLOAD_MAX_WORKERS = 10
+
+# Dataframes larger than this (in memory) are streamed to the bucket row group by row group
+PARQUET_STREAM_THRESHOLD_BYTES = 4 * RESUMABLE_UPLOAD_CHUNK_SIZE
+
+# Codecs which can be stored as `Content-Encoding` of a blob (decoded by `src.etl.extract`)
+CODECS = ["gzip", "zstd"]
+
+
+def compress(contents, codec: str) -> bytes:
+    """Compress contents with `codec`
+
+    The output only depends on the contents (gzip without timestamp), so checksums of unchanged
+    contents stay equal.
+    """
+    if isinstance(contents, str):
+        contents = contents.encode("utf-8")
+
+    if codec == "gzip":
+        return gzip.compress(contents, mtime=0)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compress(contents)
+
+    raise ValueError(
+        f"`codec` '{codec}' not allowed. Choose one of the following: {CODECS}"
+    )
 
 
 def upload_blob_from_memory(
@@ -11,21 +62,185 @@ def upload_blob_from_memory(
     contents,
     destination_blob_name: str,
     gcp_credential_block_name: str,
+    codec: str = None,
     **kwargs: dict,
 ) -> storage.bucket.Bucket.blob:
-    """Uploads a file to the bucket."""
+    """Uploads a file to the bucket.
 
-    gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
-    storage_client = gcp_credentials.get_cloud_storage_client()
+    With a `codec` the contents are compressed and stored with a matching `Content-Encoding`.
+    """
 
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
     blob = bucket.blob(destination_blob_name)
 
+    if codec is not None:
+        contents = compress(contents, codec)
+        blob.content_encoding = codec
+
     blob.upload_from_string(contents, **kwargs)
 
     return blob
 
 
+def crc32c_checksum(contents: bytes) -> str:
+    """CRC32C checksum of contents, encoded like `Blob.crc32c` (base64, big-endian)"""
+    return base64.b64encode(google_crc32c.Checksum(contents).digest()).decode("utf-8")
+
+
+class UploadStats:
+    """Counts uploads which were skipped because the stored object was unchanged"""
+
+    def __init__(self):
+        self.uploaded = 0
+        self.skipped = 0
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def record(self, size: int, skipped: bool):
+        """Count an upload of `size` bytes (or that it was skipped)"""
+        with self._lock:
+            if skipped:
+                self.skipped += 1
+                self.bytes_saved += size
+            else:
+                self.uploaded += 1
+                self.bytes_uploaded += size
+
+    def metrics(self) -> dict:
+        """Current counters, e.g. for logging"""
+        return {
+            "uploaded": self.uploaded,
+            "skipped": self.skipped,
+            "bytes_uploaded": self.bytes_uploaded,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+# Process wide counters of `upload_blob_from_memory_if_changed`
+upload_stats = UploadStats()
+
+
+def upload_blob_from_memory_if_changed(
+    bucket_name: str,
+    contents,
+    destination_blob_name: str,
+    gcp_credential_block_name: str,
+    codec: str = None,
+    **kwargs: dict,
+) -> tuple[storage.bucket.Bucket.blob, bool]:
+    """Uploads contents to the bucket unless an object with the same CRC32C checksum is stored already.
+
+    Returns the blob and whether it was uploaded. Only the object metadata is requested for the
+    comparison. The upload is conditional on the generation which was compared, so a concurrent
+    writer makes it fail (and a retry compares again) instead of being overwritten. With a
+    `codec` the compressed contents are compared and stored (see `upload_blob_from_memory`).
+    """
+
+    if isinstance(contents, str):
+        contents = contents.encode("utf-8")
+    if codec is not None:
+        contents = compress(contents, codec)
+
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
+    existing_blob = bucket.get_blob(destination_blob_name)
+
+    if existing_blob is not None and existing_blob.crc32c == crc32c_checksum(contents):
+        upload_stats.record(len(contents), skipped=True)
+        return existing_blob, False
+
+    blob = bucket.blob(destination_blob_name)
+    blob.content_encoding = codec
+    blob.upload_from_string(
+        contents,
+        if_generation_match=0 if existing_blob is None else existing_blob.generation,
+        checksum="crc32c",
+        **kwargs,
+    )
+    upload_stats.record(len(contents), skipped=False)
+
+    return blob, True
+
+
+@dataclass
+class BulkUploadResult:
+    """Outcome of a bulk upload, by blob name"""
+
+    uploaded: list[str] = field(default_factory=list)
+    skipped: list[str] = field(default_factory=list)  # Unchanged
+    failed: dict[str, str] = field(default_factory=dict)  # Error message
+
+    @property
+    def stored(self) -> list[str]:
+        """Blobs which hold the contents now (uploaded or unchanged)"""
+        return self.uploaded + self.skipped
+
+
+def upload_blobs_from_memory(
+    bucket_name: str,
+    blobs: Iterable[tuple[str, bytes]],
+    gcp_credential_block_name: str,
+    skip_unchanged: bool = True,
+    codec: str = None,
+    max_workers: int = BULK_UPLOAD_MAX_WORKERS,
+    **kwargs: dict,
+) -> BulkUploadResult:
+    """Uploads many `(blob name, contents)` to the bucket with a bounded pool of workers.
+
+    All workers share the cached client (and its connections), so the number of threads and
+    sockets doesn't grow with the number of blobs. Workers are also scaled down to the file
+    descriptors left (see `src.network.descriptors`). A failed blob doesn't stop the others, it
+    is reported in the result. Transient errors are retried by the storage client.
+    """
+
+    def upload(blob: tuple[str, bytes]) -> tuple[str, bool]:
+        """Upload a single blob (holding a slot of the descriptor limiter)"""
+        with descriptor_limiter.slot():
+            return _upload(blob)
+
+    def _upload(blob: tuple[str, bytes]) -> tuple[str, bool]:
+        """Upload a single blob"""
+        blob_name, contents = blob
+        if skip_unchanged:
+            _, uploaded = upload_blob_from_memory_if_changed(
+                bucket_name,
+                contents,
+                blob_name,
+                gcp_credential_block_name,
+                codec=codec,
+                **kwargs,
+            )
+            return blob_name, uploaded
+
+        upload_blob_from_memory(
+            bucket_name,
+            contents,
+            blob_name,
+            gcp_credential_block_name,
+            codec=codec,
+            retry=DEFAULT_RETRY,
+            **kwargs,
+        )
+        return blob_name, True
+
+    result = BulkUploadResult()
+    max_workers = descriptor_limiter.scale(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload, blob): blob[0] for blob in blobs}
+        for future, blob_name in futures.items():
+            try:
+                _, uploaded = future.result()
+            except Exception as e:
+                result.failed[blob_name] = repr(e)
+                continue
+            if uploaded:
+                result.uploaded.append(blob_name)
+            else:
+                result.skipped.append(blob_name)
+
+    return result
+
+
 def upload_blob_from_file(
     bucket_name: str,
     source_file_name: str,
@@ -35,12 +250,143 @@ def upload_blob_from_file(
 ) -> storage.bucket.Bucket.blob:
     """Uploads a file to the bucket."""
 
-    gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
-    storage_client = gcp_credentials.get_cloud_storage_client()
-
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
     blob = bucket.blob(destination_blob_name)
 
     blob.upload_from_filename(source_file_name, **kwargs)
 
     return blob
+
+
+@contextlib.contextmanager
+def open_blob_writer(
+    bucket: storage.bucket.Bucket,
+    destination_blob_name: str,
+    chunk_size: int = RESUMABLE_UPLOAD_CHUNK_SIZE,
+    **kwargs: dict,
+) -> Iterator[BlobWriter]:
+    """Resumable upload which only creates the blob if the `with` block completes
+
+    A `BlobWriter` finalizes the upload whenever it is closed, also by an exception. So the chunks
+    are written to a temporary blob, which is renamed on success and deleted on failure (instead
+    of committing a truncated file).
+    """
+
+    temporary_blob = bucket.blob(
+        f"{destination_blob_name}.partial-{uuid.uuid4().hex[:12]}"
+    )
+
+    try:
+        with temporary_blob.open(
+            "wb", chunk_size=chunk_size, ignore_flush=True, **kwargs
+        ) as writer:
+            yield writer
+    except BaseException:
+        with contextlib.suppress(NotFound):
+            temporary_blob.delete()
+        raise
+
+    bucket.rename_blob(temporary_blob, destination_blob_name)
+
+
+def upload_blob_from_stream(
+    bucket_name: str,
+    chunks: Iterable[bytes],
+    destination_blob_name: str,
+    gcp_credential_block_name: str,
+    chunk_size: int = RESUMABLE_UPLOAD_CHUNK_SIZE,
+    **kwargs: dict,
+) -> storage.bucket.Bucket.blob:
+    """Uploads a stream of chunks to the bucket using a resumable upload.
+
+    At most `chunk_size` bytes are buffered in memory, independent of the size of the file. If
+    the stream fails, no blob is created (see `open_blob_writer`) and the error is raised.
+    """
+
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
+
+    with open_blob_writer(
+        bucket, destination_blob_name, chunk_size, **kwargs
+    ) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    return bucket.blob(destination_blob_name)
+
+
+def dataframe_to_parquet(
+    df: pd.DataFrame, compression: str = "snappy", row_group_size: int = None
+) -> bytes:
+    """Serialize a Dataframe as Parquet in memory (no temporary file)"""
+
+    buffer = pa.BufferOutputStream()
+    pq.write_table(
+        pa.Table.from_pandas(df),
+        buffer,
+        compression=compression,
+        row_group_size=row_group_size,
+    )
+
+    return buffer.getvalue().to_pybytes()
+
+
+def upload_dataframe_as_parquet(
+    bucket_name: str,
+    df: pd.DataFrame,
+    destination_blob_name: str,
+    gcp_credential_block_name: str,
+    compression: str = "snappy",
+    row_group_size: int = None,
+    stream: bool = None,
+    chunk_size: int = RESUMABLE_UPLOAD_CHUNK_SIZE,
+) -> storage.bucket.Bucket.blob:
+    """Uploads a Dataframe as Parquet file to the bucket.
+
+    Small Dataframes are serialized into an in-memory buffer and uploaded at once. Large ones
+    (`stream`, by default above `PARQUET_STREAM_THRESHOLD_BYTES`) are converted and written one
+    row group at a time into a resumable upload, so neither the whole Arrow table nor the whole
+    file is held in memory. If writing fails, no blob is created (see `open_blob_writer`).
+    """
+
+    memory_usage = df.memory_usage(deep=True).sum()
+    if stream is None:
+        stream = memory_usage > PARQUET_STREAM_THRESHOLD_BYTES
+
+    if not stream:
+        return upload_blob_from_memory(
+            bucket_name,
+            dataframe_to_parquet(df, compression, row_group_size),
+            destination_blob_name,
+            gcp_credential_block_name,
+            content_type="application/octet-stream",
+        )
+
+    # Row groups of about `PARQUET_STREAM_THRESHOLD_BYTES` (in memory) by default
+    if row_group_size is None:
+        row_group_size = max(
+            1, len(df) * PARQUET_STREAM_THRESHOLD_BYTES // max(memory_usage, 1)
+        )
+
+    # Types are inferred from all rows (column by column), so every slice gets the same schema
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
+
+    with open_blob_writer(
+        bucket,
+        destination_blob_name,
+        chunk_size,
+        content_type="application/octet-stream",
+    ) as writer:
+        with pq.ParquetWriter(
+            writer, schema, compression=compression
+        ) as parquet_writer:
+            for i in range(0, len(df), row_group_size):
+                parquet_writer.write_table(
+                    pa.Table.from_pandas(
+                        df.iloc[i : i + row_group_size],
+                        schema=schema,
+                        preserve_index=False,
+                    )
+                )
+
+    return bucket.blob(destination_blob_name)
@@ -0,0 +1,174 @@
+""" Sharded storage of photo metadata: one NDJSON (or Parquet) object per page instead of one object per photo
+
+Layout inside the bucket:
+    shards/<shard_id>.json       one JSON record per line (readable by the NEWLINE_DELIMITED_JSON external table)
+    shards/<shard_id>.parquet    same records as Parquet (`file_format="parquet"`)
+    manifest/<shard_id>.csv      `photo_id,blob_name` per line, to look up the shard (or blob) of a photo
+"""
+
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.etl.clients import get_bucket, get_storage_client
+from src.etl.load import upload_blob_from_memory
+
+SHARD_PREFIX = "shards/"
+MANIFEST_PREFIX = "manifest/"
+FILE_EXTENSIONS = {"ndjson": "json", "parquet": "parquet"}
+
+# `SELECT` list which lifts the request time (RFC 1123 "Date" header) and photo id of shard records
+# to top level columns, to partition and cluster a native table by (see `load_uris`)
+SHARD_PROJECTION = """
+    PARSE_TIMESTAMP('%a, %d %b %Y %H:%M:%S GMT', request_metadata.requested_at) AS requested_at,
+    payload.id AS photo_id,
+    request_metadata.request_id AS request_id,
+    request_metadata.request_url AS request_url,
+    TO_JSON_STRING(payload) AS payload
+"""
+
+
+def shard_blob_name(shard_id: str, file_format: str = "ndjson") -> str:
+    """Blob name of a shard"""
+    if file_format not in FILE_EXTENSIONS:
+        raise ValueError(
+            f"`file_format` '{file_format}' not allowed. Choose one of the following: {list(FILE_EXTENSIONS)}"
+        )
+    return f"{SHARD_PREFIX}{shard_id}.{FILE_EXTENSIONS[file_format]}"
+
+
+def serialize_shard(records: list[dict], file_format: str = "ndjson") -> bytes:
+    """Serialize records as NDJSON or Parquet"""
+    if file_format == "ndjson":
+        return "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pylist(records), buffer)
+    return buffer.getvalue()
+
+
+def write_manifest(
+    bucket_name: str,
+    shard_id: str,
+    photo_ids: list[str],
+    blob_names: list[str],
+    gcp_credential_block_name: str,
+) -> str:
+    """Register the blobs holding the metadata of photos in the manifest"""
+    manifest_blob_name = f"{MANIFEST_PREFIX}{shard_id}.csv"
+    manifest = "".join(
+        f"{photo_id},{blob_name}\n"
+        for photo_id, blob_name in zip(photo_ids, blob_names)
+    )
+    upload_blob_from_memory(
+        bucket_name,
+        manifest.encode("utf-8"),
+        manifest_blob_name,
+        gcp_credential_block_name,
+        content_type="text/csv",
+    )
+
+    return manifest_blob_name
+
+
+def write_shard(
+    bucket_name: str,
+    shard_id: str,
+    records: list[dict],
+    photo_ids: list[str],
+    gcp_credential_block_name: str,
+    file_format: str = "ndjson",
+    codec: str = None,
+) -> str:
+    """Write records as one shard and register their photo ids in the manifest
+
+    The shard is written before its manifest, so the manifest never points to a missing shard.
+    Writing the same shard again (e.g. on a retry) overwrites it. With a `codec` the shard is
+    stored compressed (see `src.etl.load.upload_blob_from_memory`).
+    """
+    blob_name = shard_blob_name(shard_id, file_format)
+    content_type = (
+        "application/x-ndjson"
+        if file_format == "ndjson"
+        else "application/octet-stream"
+    )
+
+    upload_blob_from_memory(
+        bucket_name,
+        serialize_shard(records, file_format),
+        blob_name,
+        gcp_credential_block_name,
+        codec=codec,
+        content_type=content_type,
+    )
+
+    write_manifest(
+        bucket_name,
+        shard_id,
+        photo_ids,
+        [blob_name] * len(photo_ids),
+        gcp_credential_block_name,
+    )
+
+    return blob_name
+
+
+def list_manifest_blob_names(
+    bucket_name: str, gcp_credential_block_name: str, start_offset: str = None
+) -> list[str]:
+    """List the manifest objects of a bucket, optionally only those sorting at or after `start_offset`"""
+    storage_client = get_storage_client(gcp_credential_block_name)
+
+    return [
+        blob.name
+        for blob in storage_client.list_blobs(
+            bucket_name,
+            prefix=MANIFEST_PREFIX,
+            start_offset=start_offset,
+            fields="items(name),nextPageToken",
+        )
+    ]
+
+
+def read_manifests(
+    bucket_name: str,
+    manifest_blob_names: list[str],
+    gcp_credential_block_name: str,
+    max_workers: int = 16,
+) -> dict[str, str]:
+    """Map photo id -> blob name for the given manifest objects"""
+    bucket = get_bucket(bucket_name, gcp_credential_block_name)
+
+    def download(blob_name: str) -> str:
+        """Download a single manifest object"""
+        return bucket.blob(blob_name).download_as_bytes().decode("utf-8")
+
+    manifest = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for contents in executor.map(download, manifest_blob_names):
+            for line in contents.splitlines():
+                photo_id, shard = line.split(",", 1)
+                manifest[photo_id] = shard
+
+    return manifest
+
+
+def read_manifest(
+    bucket_name: str, gcp_credential_block_name: str, max_workers: int = 16
+) -> dict[str, str]:
+    """Map photo id -> shard blob name for all shards of a bucket"""
+    manifest_blob_names = list_manifest_blob_names(
+        bucket_name, gcp_credential_block_name
+    )
+
+    return read_manifests(
+        bucket_name, manifest_blob_names, gcp_credential_block_name, max_workers
+    )
+
+
+def is_photo_blob(blob_name: str) -> bool:
+    """Check if a blob holds the metadata of a single photo (`<photo_id>.json`, legacy layout)"""
+    return "/" not in blob_name and blob_name.endswith(".json")
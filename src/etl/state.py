@@ -0,0 +1,199 @@
+""" Local state of the ingestion progress (requested pages and processed photos), kept in SQLite
+
+"Already done" checks are answered by an embedded database instead of querying the Bigquery logs
+on every run. The database is stored as gzipped snapshot next to the data and reconciled with the
+Bigquery logs on a schedule, the logs stay the source of truth.
+"""
+
+import datetime
+import gzip
+import sqlite3
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterable
+
+from google.cloud.exceptions import NotFound
+
+from src.etl.extract import download_blob_into_memory
+from src.etl.load import upload_blob_from_memory
+
+STATE_BLOB_NAME = "state/ingestion.sqlite.gz"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS processed_photos (
+        stage TEXT NOT NULL,
+        photo_id TEXT NOT NULL,
+        PRIMARY KEY (stage, photo_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS progress (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+
+def _restore_snapshot(contents: bytes, connection: sqlite3.Connection):
+    """Copy a database file (snapshot) into a connection"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "state.sqlite"
+        path.write_bytes(contents)
+        snapshot = sqlite3.connect(path)
+        try:
+            snapshot.backup(connection)
+        finally:
+            snapshot.close()
+
+
+def _take_snapshot(connection: sqlite3.Connection) -> bytes:
+    """Copy the database of a connection into a database file (snapshot) and return its contents
+
+    `Connection.backup` is used, as `serialize` and `deserialize` need Python 3.11.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "state.sqlite"
+        snapshot = sqlite3.connect(path)
+        try:
+            connection.backup(snapshot)
+        finally:
+            snapshot.close()
+        return path.read_bytes()
+
+
+class IngestionState:
+    """Last requested page and ids processed per stage (e.g. photo ids of "metadata", "download")
+
+    The database lives in memory while a flow runs, `save` writes a snapshot of it.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], bytes | None],
+        save: Callable[[bytes], None],
+    ):
+        self._save = save
+        contents = load()
+        self.exists = contents is not None
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        if contents:
+            _restore_snapshot(gzip.decompress(contents), self.connection)
+        self.connection.executescript(SCHEMA)
+
+    @classmethod
+    def from_file(cls, path: str) -> "IngestionState":
+        """State stored in a local file"""
+        path = Path(path)
+
+        def load():
+            return path.read_bytes() if path.exists() else None
+
+        return cls(load, path.write_bytes)
+
+    @classmethod
+    def from_gcs_blob(
+        cls,
+        bucket_name: str,
+        gcp_credential_block_name: str,
+        blob_name: str = STATE_BLOB_NAME,
+    ) -> "IngestionState":
+        """State stored as blob in a Google Cloud Storage Bucket"""
+
+        def load():
+            try:
+                return download_blob_into_memory(
+                    bucket_name, blob_name, gcp_credential_block_name
+                )
+            except NotFound:
+                return None
+
+        def save(contents: bytes):
+            upload_blob_from_memory(
+                bucket_name,
+                contents,
+                blob_name,
+                gcp_credential_block_name,
+                content_type="application/gzip",
+            )
+
+        return cls(load, save)
+
+    def _get(self, key: str) -> str | None:
+        row = self.connection.execute(
+            "SELECT value FROM progress WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO progress (key, value) VALUES (?, ?)",
+                (key, value),
+            )
+
+    def last_requested_page(self) -> int:
+        """Last page of which the photo metadata has been stored (0 if none)"""
+        return int(self._get("last_requested_page") or 0)
+
+    def mark_page_requested(self, page: int):
+        """Remember a page of which the photo metadata has been stored"""
+        self._set("last_requested_page", str(max(page, self.last_requested_page())))
+
+    def processed(self, stage: str) -> set[str]:
+        """Photo ids which have been processed in a stage"""
+        rows = self.connection.execute(
+            "SELECT photo_id FROM processed_photos WHERE stage = ?", (stage,)
+        )
+        return {row[0] for row in rows}
+
+    def is_processed(self, stage: str, photo_id: str) -> bool:
+        """Check if a photo has been processed in a stage"""
+        row = self.connection.execute(
+            "SELECT 1 FROM processed_photos WHERE stage = ? AND photo_id = ?",
+            (stage, photo_id),
+        ).fetchone()
+        return row is not None
+
+    def pending(self, stage: str, photo_ids: Iterable[str]) -> list[str]:
+        """Photo ids which haven't been processed in a stage yet"""
+        return sorted(set(photo_ids) - self.processed(stage))
+
+    def mark_processed(self, stage: str, photo_ids: Iterable[str]):
+        """Remember photo ids which have been processed in a stage"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO processed_photos (stage, photo_id) VALUES (?, ?)",
+                ((stage, photo_id) for photo_id in photo_ids),
+            )
+
+    def needs_reconcile(self, stage: str, interval: datetime.timedelta) -> bool:
+        """Check if a stage hasn't been reconciled with Bigquery within `interval`"""
+        reconciled_at = self._get(f"reconciled_at:{stage}")
+        if reconciled_at is None:
+            return True
+        reconciled_at = datetime.datetime.fromisoformat(reconciled_at)
+        return datetime.datetime.now(datetime.timezone.utc) - reconciled_at >= interval
+
+    def _mark_reconciled(self, stage: str):
+        self._set(
+            f"reconciled_at:{stage}",
+            datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        )
+
+    def reconcile_pages(self, last_requested_page: int):
+        """Replace the last requested page by the one of the Bigquery request log"""
+        self._set("last_requested_page", str(last_requested_page))
+        self._mark_reconciled("pages")
+
+    def reconcile_processed(self, stage: str, photo_ids: Iterable[str]):
+        """Replace the processed photo ids of a stage by the ones of its Bigquery log"""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM processed_photos WHERE stage = ?", (stage,)
+            )
+        self.mark_processed(stage, photo_ids)
+        self._mark_reconciled(stage)
+
+    def save(self):
+        """Persist a snapshot of the state"""
+        self.connection.commit()
+        self._save(gzip.compress(_take_snapshot(self.connection)))
+        self.exists = True
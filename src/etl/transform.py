@@ -0,0 +1,52 @@
+""" Collection of Transformation functions """
+
+import pandas as pd
+import pyarrow as pa
+
+
+def _is_date_column(column_name) -> bool:
+    """Check if a column holds dates, by the same rule `pd.read_json` applies by default"""
+    if not isinstance(column_name, str):
+        return False
+    column_name = column_name.lower()
+    return (
+        column_name.endswith(("_at", "_time"))
+        or column_name.startswith("timestamp")
+        or column_name in ("modified", "date", "datetime")
+    )
+
+
+def records_to_df(
+    records: list[dict],
+    schema: pa.Schema = None,
+    flatten: bool = False,
+    max_level: int = None,
+) -> pd.DataFrame:
+    """Build a Dataframe straight from records (without a JSON round trip)
+
+    With a `schema` the columns are built by Arrow with exactly these types. Otherwise the types
+    are inferred like `pd.read_json` does: date-like columns (e.g. `updated_at`) are parsed (even
+    without any value) and other columns without any value become float columns. With `flatten`
+    nested objects become columns of their own (`links_html`), up to `max_level` levels deep.
+    """
+
+    if schema is not None:
+        return pa.Table.from_pylist(records, schema=schema).to_pandas()
+
+    if flatten:
+        df = pd.json_normalize(records, sep="_", max_level=max_level)
+    else:
+        df = pd.DataFrame.from_records(records)
+
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        if _is_date_column(column):
+            try:
+                df[column] = pd.to_datetime(df[column])
+            except (TypeError, ValueError, OverflowError):
+                pass
+        elif df[column].isna().all():
+            df[column] = df[column].astype("float64")
+
+    return df
@@ -0,0 +1,132 @@
+""" Collection of long-lived, pooled HTTP clients shared across tasks of a process """
+
+import asyncio
+import threading
+
+import httpx
+
+# Pool limits used for proxied requests unless a caller passes its own
+DEFAULT_LIMITS = httpx.Limits(
+    max_connections=100, max_keepalive_connections=30, keepalive_expiry=60
+)
+DEFAULT_TIMEOUT = httpx.Timeout(15.0, connect=10.0)
+
+
+def _proxy_key(proxies: dict | None) -> tuple:
+    """Create a hashable key for a proxy mapping (e.g. one per Bright Data session)"""
+    if proxies is None:
+        return ()
+    return tuple(sorted(proxies.items()))
+
+
+class ClientLoop:
+    """Long-lived event loop (running in a daemon thread) which owns all pooled clients
+
+    Prefect runs async tasks and subflows in event loops of their own, and an `httpx.AsyncClient`
+    can only be used in the loop it was created in. Requests are therefore sent from this loop,
+    so clients (and their keep-alive connections) are shared by all tasks of a process and can be
+    closed in the loop which owns them.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the loop on first use"""
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="http-client-loop", daemon=True
+                ).start()
+            return self._loop
+
+    async def run(self, coroutine):
+        """Run a coroutine in the client loop and wait for its result in the calling loop
+
+        Cancelling the caller (e.g. a task timeout or a losing hedge) cancels the coroutine.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._get_loop())
+        return await asyncio.wrap_future(future)
+
+
+class AsyncClientRegistry:
+    """Registry of `httpx.AsyncClient`s keyed by proxy session and pool settings
+
+    Clients are bound to the event loop they were created in, so the registry must only be used
+    from within one loop (see `ClientLoop`).
+    """
+
+    def __init__(
+        self,
+        limits: httpx.Limits = DEFAULT_LIMITS,
+        timeout: httpx.Timeout = DEFAULT_TIMEOUT,
+        http2: bool = True,
+    ):
+        self.limits = limits
+        self.timeout = timeout
+        self.http2 = http2
+        self._clients = {}
+
+    def get(
+        self,
+        proxies: dict = None,
+        limits: httpx.Limits = None,
+        http2: bool = None,
+    ) -> httpx.AsyncClient:
+        """Return the pooled client for `proxies` (create it if needed)"""
+        limits = self.limits if limits is None else limits
+        http2 = self.http2 if http2 is None else http2
+
+        key = (_proxy_key(proxies), repr(limits), http2)
+
+        client = self._clients.get(key)
+        if client is not None and not client.is_closed:
+            return client
+
+        client = httpx.AsyncClient(
+            proxies=proxies,
+            verify=False,
+            http2=http2,
+            limits=limits,
+            timeout=self.timeout,
+        )
+        self._clients[key] = client
+
+        return client
+
+    async def aclose(self):
+        """Close all clients"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+
+        for client in clients:
+            await client.aclose()
+
+
+# Process wide loop and registry, shared by all tasks of a flow run
+client_loop = ClientLoop()
+async_client_registry = AsyncClientRegistry()
+
+
+async def send_async(
+    method: str,
+    url: str,
+    proxies: dict = None,
+    limits: httpx.Limits = None,
+    http2: bool = None,
+    **kwargs,
+) -> httpx.Response:
+    """Send a request with the pooled (keep-alive, HTTP/2) client of `proxies`, from any event loop"""
+
+    async def send() -> httpx.Response:
+        client = async_client_registry.get(proxies, limits, http2)
+        return await client.request(method, url, **kwargs)
+
+    return await client_loop.run(send())
+
+
+async def close_async_clients():
+    """Close all pooled clients (in the loop which owns them)"""
+    await client_loop.run(async_client_registry.aclose())
@@ -0,0 +1,100 @@
+""" Persistent cache of response validators (ETag, Last-Modified, body digest) for conditional requests """
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Callable
+
+from google.cloud.exceptions import NotFound
+
+from src.etl.extract import download_blob_into_memory
+from src.etl.load import upload_blob_from_memory
+
+
+def body_digest(content: bytes) -> str:
+    """SHA-256 digest of a response body"""
+    return hashlib.sha256(content).hexdigest()
+
+
+class ResponseValidatorCache:
+    """Validators of the last processed response per key (e.g. per endpoint)
+
+    The validators are turned into `If-None-Match` / `If-Modified-Since` headers. A response is
+    considered unchanged if the server answers with `304 Not Modified` or if the body has the
+    same digest as last time (for servers which ignore conditional headers).
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], bytes | None],
+        save: Callable[[bytes], None],
+    ):
+        self._load = load
+        self._save = save
+        contents = load()
+        self.validators = json.loads(contents) if contents else {}
+
+    @classmethod
+    def from_file(cls, path: str) -> "ResponseValidatorCache":
+        """Cache stored in a local JSON file"""
+        path = Path(path)
+
+        def load():
+            return path.read_bytes() if path.exists() else None
+
+        return cls(load, path.write_bytes)
+
+    @classmethod
+    def from_gcs_blob(
+        cls, bucket_name: str, blob_name: str, gcp_credential_block_name: str
+    ) -> "ResponseValidatorCache":
+        """Cache stored as JSON blob in a Google Cloud Storage Bucket"""
+
+        def load():
+            try:
+                return download_blob_into_memory(
+                    bucket_name, blob_name, gcp_credential_block_name
+                )
+            except NotFound:
+                return None
+
+        def save(contents: bytes):
+            upload_blob_from_memory(
+                bucket_name,
+                contents,
+                blob_name,
+                gcp_credential_block_name,
+                content_type="application/json",
+            )
+
+        return cls(load, save)
+
+    def request_headers(self, key: str) -> dict:
+        """Conditional request headers for the last processed response of `key`"""
+        validators = self.validators.get(key, {})
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        return headers
+
+    def is_unchanged(self, key: str, response) -> bool:
+        """Check if a response equals the last processed response of `key`"""
+        if response.status_code == 304:
+            return True
+
+        digest = self.validators.get(key, {}).get("digest")
+        return digest is not None and digest == body_digest(response.content)
+
+    def update(self, key: str, response):
+        """Remember the validators of a (processed) response"""
+        self.validators[key] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "digest": body_digest(response.content),
+        }
+
+    def save(self):
+        """Persist the cache"""
+        self._save(json.dumps(self.validators).encode("utf-8"))
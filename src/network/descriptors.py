@@ -0,0 +1,140 @@
+""" Process wide limiter of in-flight requests and uploads, based on the file descriptors left """
+
+import asyncio
+import contextlib
+import os
+import resource
+import threading
+import time
+
+
+def open_descriptor_count() -> int:
+    """Number of file descriptors (files, sockets, pipes) the process has open (0 if unknown)"""
+    for fd_directory in ("/proc/self/fd", "/dev/fd"):  # Linux, macOS
+        try:
+            return len(os.listdir(fd_directory))
+        except OSError:
+            continue
+    return 0
+
+
+def raise_descriptor_limit(target: int = 65536) -> int:
+    """Raise the soft `RLIMIT_NOFILE` towards the hard limit (at most `target`), return the new soft limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        target = min(target, hard)
+    if target > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class DescriptorLimiter:
+    """Limits concurrent requests and uploads (slots) to the file descriptors the process has left
+
+    The capacity is derived from the soft `RLIMIT_NOFILE` minus a reserve and minus the
+    descriptors open right now (pooled keep-alive connections, log files, ...). Each slot is
+    assumed to need `descriptors_per_slot` descriptors, e.g. a socket to the API and one to GCS.
+    Descriptors held by slots in flight are counted as part of the budget, so the capacity
+    doesn't shrink while slots are used.
+    """
+
+    def __init__(
+        self,
+        descriptors_per_slot: int = 2,
+        reserve_ratio: float = 0.25,
+        max_slots: int = 256,
+        poll_interval_seconds: float = 0.05,
+    ):
+        self.descriptors_per_slot = descriptors_per_slot
+        self.reserve_ratio = reserve_ratio
+        self.max_slots = max_slots
+        self.poll_interval_seconds = poll_interval_seconds
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.waits = 0
+        self._lock = threading.Lock()
+
+    def capacity(self) -> int:
+        """Number of slots which fit into the descriptors left (at least 1)"""
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit == resource.RLIM_INFINITY:
+            return self.max_slots
+
+        budget = (
+            soft_limit * (1 - self.reserve_ratio)
+            - open_descriptor_count()
+            + self.in_flight * self.descriptors_per_slot
+        )
+        slots = int(budget // self.descriptors_per_slot)
+        return max(1, min(self.max_slots, slots))
+
+    def scale(self, requested: int) -> int:
+        """Scale a requested concurrency (e.g. workers or a window of requests) to the capacity"""
+        return max(1, min(requested, self.capacity()))
+
+    def _try_acquire(self) -> bool:
+        """Take a slot if one is free"""
+        with self._lock:
+            if self.in_flight >= self.capacity():
+                return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def acquire(self):
+        """Block until a slot is free"""
+        if self._try_acquire():
+            return
+        self.waits += 1
+        while not self._try_acquire():
+            time.sleep(self.poll_interval_seconds)
+
+    async def acquire_async(self):
+        """Wait (without blocking the event loop) until a slot is free"""
+        if self._try_acquire():
+            return
+        self.waits += 1
+        while not self._try_acquire():
+            await asyncio.sleep(self.poll_interval_seconds)
+
+    def release(self):
+        """Free a slot"""
+        with self._lock:
+            self.in_flight -= 1
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a slot while the block runs"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self):
+        """Hold a slot while the (async) block runs"""
+        await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def metrics(self) -> dict:
+        """Current state of the limiter, e.g. for logging"""
+        return {
+            "soft_limit": resource.getrlimit(resource.RLIMIT_NOFILE)[0],
+            "open_descriptors": open_descriptor_count(),
+            "capacity": self.capacity(),
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "waits": self.waits,
+        }
+
+
+# Process wide limiter, shared by all requests and uploads of a flow run
+descriptor_limiter = DescriptorLimiter()
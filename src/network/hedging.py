@@ -0,0 +1,134 @@
+""" Hedged requests: duplicate slow requests through another proxy session and keep the first response """
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+
+class LatencyTracker:
+    """Rolling window of request latencies"""
+
+    def __init__(self, window_size: int = 200):
+        self._latencies = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def record(self, latency_seconds: float):
+        """Add a latency sample"""
+        with self._lock:
+            self._latencies.append(latency_seconds)
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def percentile(self, q: float) -> float | None:
+        """Latency below which `q` (0-1) of the samples are (None without samples)"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) == 0:
+            return None
+        index = min(len(latencies) - 1, int(q * len(latencies)))
+        return latencies[index]
+
+
+class RequestHedger:
+    """Sends a backup request once the primary one is slower than a latency percentile
+
+    The first response wins, the other request is cancelled. Hedges are limited to a share of all
+    requests (`budget_ratio`), so a degraded proxy can't double the load.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.9,
+        min_samples: int = 20,
+        min_delay_seconds: float = 0.5,
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay_seconds = min_delay_seconds
+        self.latencies = LatencyTracker()
+        self.requests = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+
+    def hedge_delay(self) -> float | None:
+        """Seconds to wait for the primary request before hedging (None: too few samples yet)"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(self.min_delay_seconds, self.latencies.percentile(self.percentile))
+
+    def _try_acquire_hedge(self, budget_ratio: float) -> bool:
+        """Check if another hedge fits into the budget and count it"""
+        with self._lock:
+            if self.hedges + 1 > budget_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    async def run(
+        self,
+        primary: Callable[[], Awaitable],
+        backup: Callable[[], Awaitable] | None,
+        budget_ratio: float,
+    ):
+        """Await `primary()` and hedge it with `backup()` if it is too slow"""
+        with self._lock:
+            self.requests += 1
+
+        start_time = time.perf_counter()
+        primary_task = asyncio.ensure_future(primary())
+        delay = self.hedge_delay()
+
+        if backup is None or budget_ratio <= 0 or delay is None:
+            result = await primary_task
+            self.latencies.record(time.perf_counter() - start_time)
+            return result
+
+        tasks = {primary_task}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._try_acquire_hedge(budget_ratio):
+                result = await primary_task
+                self.latencies.record(time.perf_counter() - start_time)
+                return result
+
+            backup_task = asyncio.ensure_future(backup())
+            tasks.add(backup_task)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                succeeded = [task for task in done if task.exception() is None]
+                winner = succeeded[0] if succeeded else next(iter(done))
+                # A failed request only loses if the other one can still answer
+                if succeeded or not pending:
+                    break
+        finally:
+            # Cancel the loser (or both, if the caller got cancelled)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        if winner is backup_task and winner.exception() is None:
+            with self._lock:
+                self.hedges_won += 1
+
+        self.latencies.record(time.perf_counter() - start_time)
+        return winner.result()
+
+    def metrics(self) -> dict:
+        """Current state of the hedger, e.g. for logging"""
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "hedge_delay_seconds": self.hedge_delay(),
+        }
+
+
+# Process wide hedger, shared by all requests of a flow run
+request_hedger = RequestHedger()
@@ -0,0 +1,224 @@
+""" Pool of sticky Bright Data proxy sessions which are scored by latency and error rate """
+
+import functools
+import random
+import threading
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
+
+from prefect.blocks.system import Secret
+
+PROXY_HOST = "brd.superproxy.io"
+PROXY_PORT = 22225
+PROXY_TYPES = ["residential", "datacenter"]
+
+# Status codes which indicate the proxy session (its exit IP) is blocked or overloaded
+PROXY_ERROR_STATUS_CODES = {403, 407, 429, 502, 503, 504}
+
+
+@functools.lru_cache(maxsize=None)
+def load_proxy_credentials(proxy_type: str) -> tuple[str, str]:
+    """Load username and password of a proxy zone (cached for the whole process)"""
+    if proxy_type not in PROXY_TYPES:
+        raise ValueError(
+            f"`proxy_type` '{proxy_type}' not allowed. Choose one of the following: {PROXY_TYPES}"
+        )
+
+    prefect_block_prefix = "unsplash-photo-trends-bright-data"
+    username = Secret.load(f"{prefect_block_prefix}-{proxy_type}-proxy-username").get()
+    password = Secret.load(f"{prefect_block_prefix}-{proxy_type}-proxy-password").get()
+
+    return username, password
+
+
+@dataclass(eq=False)
+class ProxySession:
+    """Sticky proxy session (same exit IP) and its observed performance"""
+
+    proxy_type: str
+    username: str = field(repr=False)
+    password: str = field(repr=False)
+    session_id: str = field(default_factory=lambda: str(random.random()))
+    requests: int = 0
+    errors: int = 0
+    latency_ewma: float = None  # seconds
+
+    @property
+    def proxy_url(self) -> str:
+        """Proxy URL including the session, e.g. http://user-session-0.42:pw@host:port"""
+        return f"http://{self.username}-session-{self.session_id}:{self.password}@{PROXY_HOST}:{PROXY_PORT}"
+
+    def proxies(self, httpx_format: bool = False) -> dict:
+        """Proxy mapping as expected by `requests` or (with `httpx_format`) by `httpx`"""
+        if httpx_format:
+            return {"http://": self.proxy_url, "https://": self.proxy_url}
+        return {"http": self.proxy_url, "https": self.proxy_url}
+
+    @property
+    def error_rate(self) -> float:
+        """Share of requests through this session which failed"""
+        return self.errors / self.requests if self.requests else 0.0
+
+    @property
+    def score(self) -> float:
+        """Expected cost of a request through this session (lower is better)"""
+        if self.latency_ewma is None:
+            return 0.0  # Try unknown sessions first
+        return self.latency_ewma * (1 + 4 * self.error_rate)
+
+
+class ProxySessionPool:
+    """Pool of sticky sessions per proxy type
+
+    Requests are spread over the sessions at random, weighted by the inverse of their score,
+    so faster sessions get more traffic without one session taking all of it. Sessions which
+    fail too often or are too slow get evicted and replaced by a fresh session (new exit IP).
+    """
+
+    def __init__(
+        self,
+        size: int = 10,
+        min_requests: int = 3,
+        max_error_rate: float = 0.3,
+        max_latency_seconds: float = 10.0,
+        smoothing: float = 0.3,
+    ):
+        self.size = size
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.max_latency_seconds = max_latency_seconds
+        self.smoothing = smoothing
+        self.evictions = 0
+        self._sessions = {}  # proxy type -> list of sessions
+        self._sessions_by_url = {}
+        self._proxy_types_by_username = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self, proxy_type: str) -> ProxySession:
+        """Create a new session and make it discoverable by its proxy url"""
+        username, password = load_proxy_credentials(proxy_type)
+        session = ProxySession(proxy_type, username, password)
+        self._sessions_by_url[session.proxy_url] = session
+        self._proxy_types_by_username[username] = proxy_type
+        return session
+
+    def get(self, proxy_type: str, exclude: ProxySession = None) -> ProxySession:
+        """Get a healthy session (other than `exclude`), picked at random weighted by score
+
+        Sessions without measurements yet are tried first. Unhealthy sessions are evicted as
+        soon as their stats are recorded, so every pooled session counts as healthy.
+        """
+        with self._lock:
+            sessions = self._sessions.setdefault(proxy_type, [])
+            while len(sessions) < self.size:
+                sessions.append(self._new_session(proxy_type))
+
+            candidates = [s for s in sessions if s is not exclude] or sessions
+            untried = [s for s in candidates if s.score <= 0]
+            if untried:
+                return random.choice(untried)
+            return random.choices(
+                candidates, weights=[1 / s.score for s in candidates]
+            )[0]
+
+    def sessions(self, proxy_type: str) -> list[ProxySession]:
+        """All sessions of a proxy type currently in the pool"""
+        with self._lock:
+            return list(self._sessions.get(proxy_type, []))
+
+    def lookup(self, proxies: dict) -> ProxySession | None:
+        """Find the session a proxy mapping (requests or httpx format) belongs to"""
+        if not proxies:
+            return None
+        for proxy_url in proxies.values():
+            session = self._sessions_by_url.get(proxy_url)
+            if session is not None:
+                return session
+        return None
+
+    def proxy_type(self, proxies: dict) -> str | None:
+        """Find the proxy type of a proxy mapping, even if its session got evicted already"""
+        if not proxies:
+            return None
+        for proxy_url in proxies.values():
+            username = urlparse(proxy_url).username or ""
+            proxy_type = self._proxy_types_by_username.get(
+                username.split("-session-")[0]
+            )
+            if proxy_type is not None:
+                return proxy_type
+        return None
+
+    def record(self, proxies: dict, latency_seconds: float, success: bool):
+        """Update the stats of the session used for a request and evict it if unhealthy"""
+        session = self.lookup(proxies)
+        if session is None:
+            return
+
+        with self._lock:
+            session.requests += 1
+            if not success:
+                session.errors += 1
+            if session.latency_ewma is None:
+                session.latency_ewma = latency_seconds
+            else:
+                session.latency_ewma += self.smoothing * (
+                    latency_seconds - session.latency_ewma
+                )
+
+            if self._is_unhealthy(session):
+                self._evict(session)
+
+    def _is_unhealthy(self, session: ProxySession) -> bool:
+        """Check if a session failed too often or got too slow"""
+        if session.requests < self.min_requests:
+            return False
+        return (
+            session.error_rate > self.max_error_rate
+            or session.latency_ewma > self.max_latency_seconds
+        )
+
+    def _evict(self, session: ProxySession):
+        """Replace a session with a fresh one and forget the evicted session's URL"""
+        sessions = self._sessions.get(session.proxy_type, [])
+        if session in sessions:
+            sessions.remove(session)
+            self._sessions_by_url.pop(session.proxy_url, None)
+            sessions.append(self._new_session(session.proxy_type))
+            self.evictions += 1
+
+
+# Process wide pool, shared by all flows and tasks
+proxy_session_pool = ProxySessionPool()
+
+
+def get_proxies(proxy_type: str, httpx_format: bool = False) -> dict:
+    """Get the proxy mapping of a healthy session of a proxy type (faster ones more likely)"""
+    return proxy_session_pool.get(proxy_type).proxies(httpx_format)
+
+
+def get_alternative_proxies(proxies: dict) -> dict | None:
+    """Get the proxy mapping (same format) of another session of the same proxy type
+
+    Works for evicted sessions as well. Returns None if `proxies` doesn't belong to the pool.
+    """
+    proxy_type = proxy_session_pool.proxy_type(proxies)
+    if proxy_type is None:
+        return None
+
+    alternative = proxy_session_pool.get(
+        proxy_type, exclude=proxy_session_pool.lookup(proxies)
+    )
+    return alternative.proxies(httpx_format="http://" in proxies)
+
+
+def proxy_session_id(proxies: dict) -> str | None:
+    """Id of the pooled session a proxy mapping belongs to (None if it isn't pooled)"""
+    session = proxy_session_pool.lookup(proxies)
+    return None if session is None else session.session_id
+
+
+def record_proxy_result(proxies: dict, latency_seconds: float, status_code: int = None):
+    """Feed the outcome of a request back into the pool (`status_code` None means it failed)"""
+    success = status_code is not None and status_code not in PROXY_ERROR_STATUS_CODES
+    proxy_session_pool.record(proxies, latency_seconds, success)
@@ -0,0 +1,122 @@
+""" Token bucket governor which paces requests according to observed X-Ratelimit headers """
+
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class RateLimitGovernor:
+    """Token bucket shared by all (sync and async) requests to a host
+
+    The bucket starts unlimited and only starts pacing once a response carried
+    `X-Ratelimit-Limit` and `X-Ratelimit-Remaining` headers. From then on the server side
+    quota is the source of truth: the bucket holds the remaining requests minus a reserve and
+    refills at `limit / window_seconds`, so requests are spread out before the quota hits zero
+    instead of failing with 403/429.
+    """
+
+    def __init__(self, window_seconds: float = 3600, reserve_ratio: float = 0.1):
+        self.window_seconds = window_seconds
+        self.reserve_ratio = reserve_ratio
+        self.limit = None
+        self.remaining = None
+        self.tokens = float("inf")
+        self.refill_rate = 0.0  # tokens per second
+        self.waits = 0
+        self.total_wait_seconds = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        """Add tokens which accrued since the last refill"""
+        if self.limit is not None:
+            capacity = self.limit * (1 - self.reserve_ratio)
+            accrued = (now - self._last_refill) * self.refill_rate
+            self.tokens = min(capacity, self.tokens + accrued)
+        self._last_refill = now
+
+    def _reserve(self) -> float:
+        """Take a token and return how many seconds the caller has to wait for it"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0.0
+
+            wait_seconds = -self.tokens / self.refill_rate
+            self.waits += 1
+            self.total_wait_seconds += wait_seconds
+            return wait_seconds
+
+    def acquire(self) -> float:
+        """Block until a request may be sent, return the time waited"""
+        wait_seconds = self._reserve()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    async def acquire_async(self) -> float:
+        """Wait (without blocking the event loop) until a request may be sent"""
+        wait_seconds = self._reserve()
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        return wait_seconds
+
+    def update_from_headers(self, headers) -> bool:
+        """Sync the bucket with the quota reported by the server, return if headers were found"""
+        try:
+            limit = int(headers["X-Ratelimit-Limit"])
+            remaining = int(headers["X-Ratelimit-Remaining"])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        if limit <= 0:
+            return False
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self.limit = limit
+            self.remaining = remaining
+            self.refill_rate = limit / self.window_seconds
+            # Requests which already reserved a future token (negative balance) stay reserved
+            usable = remaining - limit * self.reserve_ratio
+            self.tokens = usable + min(self.tokens, 0)
+
+        return True
+
+    @property
+    def consumed_quota(self) -> float | None:
+        """Share of the quota consumed in the current window (None if unknown)"""
+        if not self.limit:
+            return None
+        return (self.limit - self.remaining) / self.limit
+
+    def metrics(self) -> dict:
+        """Current state of the governor, e.g. for logging"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "limit": self.limit,
+                "remaining": self.remaining,
+                "consumed_quota": self.consumed_quota,
+                "tokens": self.tokens,
+                "refill_rate_per_second": self.refill_rate,
+                "waits": self.waits,
+                "total_wait_seconds": round(self.total_wait_seconds, 3),
+            }
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_rate_limit_governor(url: str) -> RateLimitGovernor:
+    """Get the process wide governor for the host of `url`"""
+    host = urlparse(url).netloc or url
+
+    with _governors_lock:
+        if host not in _governors:
+            _governors[host] = RateLimitGovernor()
+        return _governors[host]
@@ -0,0 +1,278 @@
+""" Retry engine with error classification, jittered exponential backoff and circuit breakers """
+
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable
+
+import httpx
+import requests
+
+# Error classes
+RATE_LIMITED = "rate_limited"  # 429
+BLOCKED = "blocked"  # 403, e.g. the exit IP of a proxy session got blocked
+SERVER_ERROR = "server_error"  # 5xx
+TIMEOUT = "timeout"
+CONNECTION_ERROR = "connection_error"
+
+# Error classes which count as failure of the host or of the proxy session
+HOST_FAILURES = {SERVER_ERROR, TIMEOUT, CONNECTION_ERROR}
+PROXY_FAILURES = {RATE_LIMITED, BLOCKED, TIMEOUT, CONNECTION_ERROR}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host or proxy session which keeps failing"""
+
+
+def classify_status_code(status_code: int) -> str | None:
+    """Classify an HTTP status code (None if it is no retryable error)"""
+    if status_code == 429:
+        return RATE_LIMITED
+    if status_code == 403:
+        return BLOCKED
+    if status_code >= 500:
+        return SERVER_ERROR
+    return None
+
+
+def classify_exception(exception: BaseException) -> str | None:
+    """Classify an exception of `requests` or `httpx` (None if it is no retryable error)"""
+    if isinstance(exception, (requests.Timeout, httpx.TimeoutException)):
+        return TIMEOUT
+    if isinstance(exception, (requests.ConnectionError, httpx.TransportError)):
+        return CONNECTION_ERROR
+    return None
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a `Retry-After` header (delay in seconds or HTTP date) into seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class RetryPolicy:
+    """How often and how long to wait before retrying a failed request"""
+
+    max_attempts: int = 4
+    base_delay_seconds: float = 1.0
+    max_delay_seconds: float = 30.0
+    retry_on: frozenset = frozenset(
+        {RATE_LIMITED, BLOCKED, SERVER_ERROR, TIMEOUT, CONNECTION_ERROR}
+    )
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Delay before the next attempt: `Retry-After` if given, otherwise exponential backoff with full jitter"""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay_seconds)
+        backoff = min(
+            self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1)
+        )
+        return random.uniform(0, backoff)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+# Short delays, so all attempts fit into the timeout of async request tasks
+ASYNC_RETRY_POLICY = RetryPolicy(
+    max_attempts=3, base_delay_seconds=0.5, max_delay_seconds=4.0
+)
+
+
+class CircuitBreaker:
+    """Stops requests to a host or proxy session after `failure_threshold` consecutive failures
+
+    After `reset_timeout_seconds` a single trial request is let through (half open). If it
+    succeeds the circuit closes again, otherwise it stays open for another timeout.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """`closed`, `open` or `half_open`"""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout_seconds:
+            return "half_open"
+        return "open"
+
+    def acquire(self) -> str | None:
+        """Let a request through: "closed", "trial" (the single request while half open) or None"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return "closed"
+            if state == "half_open" and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return "trial"
+            return None
+
+    def allow(self) -> bool:
+        """Check if a request may be sent"""
+        return self.acquire() is not None
+
+    def release_trial(self):
+        """Give back the trial of a request which didn't complete (e.g. cancelled or not sent)"""
+        with self._lock:
+            self._trial_in_progress = False
+
+    def record_success(self):
+        """Close the circuit"""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        """Count a failure and open the circuit once the threshold is reached"""
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_progress or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(key: str) -> CircuitBreaker:
+    """Get the process wide circuit breaker of a host or proxy session"""
+    with _circuit_breakers_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker()
+        return _circuit_breakers[key]
+
+
+class _Attempts:
+    """Bookkeeping shared by the sync and async retry loop"""
+
+    def __init__(self, policy: RetryPolicy, host: str, proxy_session: str = None):
+        self.policy = policy
+        self.attempt = 0
+        self.breakers = {"host": get_circuit_breaker(f"host:{host}")}
+        if proxy_session is not None:
+            self.breakers["proxy"] = get_circuit_breaker(f"proxy:{proxy_session}")
+        self._trials = []
+
+    def start(self):
+        """Start the next attempt (fails fast if a circuit is open)
+
+        Half open trials are only kept if all circuits let the attempt through.
+        """
+        self.attempt += 1
+        for name, breaker in self.breakers.items():
+            acquired = breaker.acquire()
+            if acquired is None:
+                self.abort()
+                raise CircuitOpenError(
+                    f"Circuit of {name} is open after {breaker.failures} consecutive failures"
+                )
+            if acquired == "trial":
+                self._trials.append(breaker)
+
+    def abort(self):
+        """Give back the half open trials of an attempt which didn't complete"""
+        for breaker in self._trials:
+            breaker.release_trial()
+        self._trials = []
+
+    def finish(self, error: str | None, retry_after: float = None) -> float | None:
+        """Record the outcome and return the delay before retrying (None: don't retry)"""
+        self._trials = []
+        for name, breaker in self.breakers.items():
+            failures = HOST_FAILURES if name == "host" else PROXY_FAILURES
+            if error in failures:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+        if error is None or error not in self.policy.retry_on:
+            return None
+        if self.attempt >= self.policy.max_attempts:
+            return None
+        return self.policy.delay(self.attempt, retry_after)
+
+
+def _outcome(response) -> tuple[str | None, float | None]:
+    """Error class and `Retry-After` of a response"""
+    error = classify_status_code(response.status_code)
+    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    return error, retry_after
+
+
+def send_with_retry(
+    send: Callable[[], requests.Response],
+    host: str,
+    proxy_session: str = None,
+    policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+):
+    """Call `send` until it succeeds, isn't retryable or the attempts are used up
+
+    Returns the last response (so the caller can `raise_for_status`) or raises the last exception.
+    """
+    attempts = _Attempts(policy, host, proxy_session)
+
+    while True:
+        attempts.start()
+        try:
+            response = send()
+        except Exception as e:
+            delay = attempts.finish(classify_exception(e))
+            if delay is None:
+                raise
+        except BaseException:
+            attempts.abort()
+            raise
+        else:
+            delay = attempts.finish(*_outcome(response))
+            if delay is None:
+                return response
+            response.close()  # Release the connection of a (streamed) failed response
+
+        time.sleep(delay)
+
+
+async def send_with_retry_async(
+    send: Callable[[], Awaitable[httpx.Response]],
+    host: str,
+    proxy_session: str = None,
+    policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+):
+    """Async version of `send_with_retry`"""
+    attempts = _Attempts(policy, host, proxy_session)
+
+    while True:
+        attempts.start()
+        try:
+            response = await send()
+        except Exception as e:
+            delay = attempts.finish(classify_exception(e))
+            if delay is None:
+                raise
+        except BaseException:  # e.g. cancelled by a timeout or as losing hedge
+            attempts.abort()
+            raise
+        else:
+            delay = attempts.finish(*_outcome(response))
+            if delay is None:
+                return response
+
+        await asyncio.sleep(delay)
@@ -0,0 +1,83 @@
+""" Pre-built pool of User-Agent strings, weighted by browser share """
+
+import random
+import threading
+import time
+
+from fake_useragent import UserAgent
+
+DEFAULT_BROWSERS = ("chrome", "firefox", "safari")
+
+
+class UserAgentPool:
+    """User-Agent strings filtered and weighted once, so drawing one is (almost) free
+
+    The pool is built on first use and rebuilt lazily once it is older than `max_age_seconds`.
+    """
+
+    def __init__(
+        self,
+        browsers=DEFAULT_BROWSERS,
+        min_percentage: float = 1.5,
+        max_age_seconds: float = 24 * 60 * 60,
+    ):
+        self.browsers = list(browsers)
+        self.min_percentage = min_percentage
+        self.max_age_seconds = max_age_seconds
+        self._population = ([], [])  # (User-Agents, weights), swapped as a whole
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        """Load the browser dataset and keep the matching User-Agents and their usage share"""
+        ua = UserAgent(browsers=self.browsers, min_percentage=self.min_percentage)
+        entries = [
+            entry
+            for entry in ua.data_browsers
+            if entry["browser"] in ua.browsers
+            and entry["os"] in ua.os
+            and entry["percent"] >= ua.min_percentage
+        ]
+
+        if len(entries) > 0:
+            self._population = (
+                [entry["useragent"] for entry in entries],
+                [entry["percent"] for entry in entries],
+            )
+        else:
+            self._population = ([ua.fallback], [1.0])
+
+        self._built_at = time.monotonic()
+
+    def _is_stale(self) -> bool:
+        """Check if the pool has to be (re)built"""
+        return (
+            self._built_at is None
+            or time.monotonic() - self._built_at > self.max_age_seconds
+        )
+
+    def random(self) -> str:
+        """Draw a User-Agent string, weighted by browser share"""
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self._build()
+
+        useragents, weights = self._population
+        return random.choices(useragents, weights=weights)[0]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def random_useragent(browsers=DEFAULT_BROWSERS, min_percentage: float = 1.5) -> str:
+    """Draw a random User-Agent string from the (process wide) pool"""
+    key = (tuple(browsers), min_percentage)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = UserAgentPool(browsers, min_percentage)
+        pool = _pools[key]
+
+    return pool.random()
@@ -1,28 +1,67 @@
 """ Collection of generic tasks that can be reused across flows """
 
 import datetime
-import json
-import random
-from tempfile import NamedTemporaryFile
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
+from urllib.parse import urlparse
 
 import httpx
 import pandas as pd
+import pyarrow as pa
 import requests
-from fake_useragent import UserAgent
 from google.cloud import storage
 
-from prefect import get_run_logger, task
+from prefect import flow, get_run_logger, task
 from prefect.blocks.system import Secret
 from prefect.tasks import task_input_hash
-from src.etl.load import upload_blob_from_file, upload_blob_from_memory
+from src.etl.clients import get_bucket
+from src.etl.load import (
+    BULK_UPLOAD_MAX_WORKERS,
+    RESUMABLE_UPLOAD_CHUNK_SIZE,
+    BulkUploadResult,
+    upload_blob_from_memory,
+    upload_blob_from_memory_if_changed,
+    upload_blob_from_stream,
+    upload_blobs_from_memory,
+    upload_dataframe_as_parquet,
+    upload_stats,
+)
+from src.etl.transform import records_to_df
+from src.network.clients import close_async_clients, send_async
+from src.network.descriptors import descriptor_limiter
+from src.network.hedging import request_hedger
+from src.network.proxies import (
+    get_alternative_proxies,
+    get_proxies,
+    proxy_session_id,
+    record_proxy_result,
+)
+from src.network.rate_limit import get_rate_limit_governor
+from src.network.retry import (
+    ASYNC_RETRY_POLICY,
+    DEFAULT_RETRY_POLICY,
+    RetryPolicy,
+    send_with_retry,
+    send_with_retry_async,
+)
+from src.network.useragents import random_useragent
+
+# Connect and read timeout of requests sent with `requests` (the read timeout is the longest
+# silence between two bytes, not the duration of the whole download)
+REQUEST_TIMEOUT_SECONDS = (10, 30)
 
 
 @task
 def prepare_proxy_adresses(
     proxy_type=Literal["residential", "datacenter"],
 ) -> dict:
-    """Prepare proxy adress to it can be used in a request"""
+    """Prepare proxy adress to it can be used in a request
+
+    Credentials are cached for the whole process and the adress belongs to the fastest
+    healthy sticky session of the proxy session pool.
+    """
 
     allowed_proxy_types = ["residential", "datacenter"]
     if proxy_type not in allowed_proxy_types:
@@ -30,31 +69,7 @@ def prepare_proxy_adresses(
             f"`proxy_type` '{proxy_type}' not allowed. Choose one of the following: {allowed_proxy_types}"
         )
 
-    host = "brd.superproxy.io"
-    port = 22225
-
-    if proxy_type == "residential":
-        prefect_block_prefix = "unsplash-photo-trends-bright-data"
-        username = Secret.load(
-            f"{prefect_block_prefix}-residential-proxy-username"
-        ).get()
-        password = Secret.load(
-            f"{prefect_block_prefix}-residential-proxy-password"
-        ).get()
-
-    if proxy_type == "datacenter":
-        prefect_block_prefix = "unsplash-photo-trends-bright-data"
-        username = Secret.load(
-            f"{prefect_block_prefix}-datacenter-proxy-username"
-        ).get()
-        password = Secret.load(
-            f"{prefect_block_prefix}-datacenter-proxy-password"
-        ).get()
-
-    session_id = random.random()
-    proxy_url = f"http://{username}-session-{session_id}:{password}@{host}:{port}"
-
-    proxies = {"http": proxy_url, "https": proxy_url}
+    proxies = get_proxies(proxy_type)
 
     return proxies
 
@@ -64,8 +79,7 @@ def create_random_ua_string(
     browsers=["chrome", "firefox", "safari"], min_percentage=1.5
 ) -> str:
     """Creata a random Useragent string"""
-    ua = UserAgent(browsers=browsers, min_percentage=min_percentage)
-    random_useragent_string = ua.random
+    random_useragent_string = random_useragent(browsers, min_percentage)
 
     return random_useragent_string
 
@@ -84,15 +98,20 @@ def inspect_request(proxies: dict, headers: dict):
     return response.json()
 
 
-@task(retries=3, retry_delay_seconds=10)
+@task
 def request_unsplash_api(
     endpoint: str,
     proxies: dict = None,
     headers: dict = None,
     params: dict = {"per_page": 30},
     base_url: str = "https://api.unsplash.com",
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    timeout: tuple[float, float] = REQUEST_TIMEOUT_SECONDS,
 ) -> requests.Response:
-    """Request data from Unsplash API Endpoint"""
+    """Request data from Unsplash API Endpoint
+
+    Failed requests (429, 403, 5xx, timeouts) are retried according to `retry_policy`.
+    """
     logger = get_run_logger()
 
     # Add API key to params if official API endpoint
@@ -103,30 +122,60 @@ def request_unsplash_api(
 
     URI = base_url + endpoint
 
-    logger.info(f"Requesting endpoint: {URI}")
-    response = requests.get(
-        url=URI, params=params, proxies=proxies, verify=False, headers=headers
-    )
+    governor = get_rate_limit_governor(base_url)
 
-    response.raise_for_status()
+    def send() -> requests.Response:
+        """Send a single request"""
+        # Wait for a token of the rate limit governor shared by all requests to this host
+        waited_seconds = governor.acquire()
+        if waited_seconds > 0:
+            logger.info(
+                f"Waited {waited_seconds:.2f} seconds to stay within rate limit"
+            )
 
-    # Check Rate Limiting
-    if base_url == "https://api.unsplash.com":
-        rate_limit_limit = int(response.headers["X-Ratelimit-Limit"])
-        rate_limit_remaining = int(response.headers["X-Ratelimit-Remaining"])
-        consumed_quota = (rate_limit_limit - rate_limit_remaining) / rate_limit_limit
+        logger.info(f"Requesting endpoint: {URI}")
+        start_time = time.perf_counter()
+        try:
+            with descriptor_limiter.slot():
+                response = requests.get(
+                    url=URI,
+                    params=params,
+                    proxies=proxies,
+                    verify=False,
+                    headers=headers,
+                    timeout=timeout,
+                )
+        except requests.RequestException:
+            record_proxy_result(proxies, time.perf_counter() - start_time)
+            raise
+        record_proxy_result(
+            proxies, time.perf_counter() - start_time, response.status_code
+        )
+
+        return response
+
+    response = send_with_retry(
+        send, urlparse(base_url).netloc, proxy_session_id(proxies), retry_policy
+    )
+
+    # Check Rate Limiting (before raising, so 403/429 responses also update the governor)
+    if governor.update_from_headers(response.headers):
+        consumed_quota = governor.consumed_quota
 
         if consumed_quota > 0.8:
             logger.warning(
                 f"Rate limit almost reached: {consumed_quota*100} % of Quota consumed"
             )
-            logger.warning(f"Remaining requests: {rate_limit_remaining}")
+            logger.warning(f"Remaining requests: {governor.remaining}")
+            logger.info(f"Rate limit governor state: {governor.metrics()}")
 
-        if rate_limit_remaining == 0:
+        if governor.remaining == 0:
             logger.error(
                 f"Rate limit reached: {consumed_quota*100} % of Quota consumed. Wait to continue"
             )
 
+    response.raise_for_status()
+
     return response
 
 
@@ -141,20 +190,74 @@ async def request_unsplash_api_async(
     headers: dict = None,
     params: dict = None,
     base_url="https://unsplash.com/napi",
+    retry_policy: RetryPolicy = ASYNC_RETRY_POLICY,
+    hedge_budget: float = 0.0,
 ):
-    """Asynchrously request data Unsplash API endpoint"""
+    """Asynchrously request data Unsplash API endpoint
+
+    The underlying client is pooled per proxy session and shared across all calls of the process
+    (see `src.network.clients`), so TCP/TLS handshakes (through the proxy) are only paid once per
+    connection. Failed requests are retried according to `retry_policy` (which has to fit into
+    the task timeout).
+
+    With a `hedge_budget` > 0, a request slower than the 90th latency percentile is duplicated
+    through another proxy session and the first response wins. At most `hedge_budget` (share of
+    all requests) are hedged.
+    """
     logger = get_run_logger()
 
-    async with httpx.AsyncClient(proxies=proxies, verify=False) as client:
-        URI = base_url + endpoint
+    URI = base_url + endpoint
 
-        logger.info(f"Requesting URI: {URI}")
-        response = await client.get(url=URI, params=params, headers=headers)
+    governor = get_rate_limit_governor(base_url)
+
+    async def get(client_proxies: dict) -> httpx.Response:
+        """Send a single request through `client_proxies`"""
+        start_time = time.perf_counter()
+        try:
+            async with descriptor_limiter.slot_async():
+                response = await send_async(
+                    "GET", URI, client_proxies, params=params, headers=headers
+                )
+        except httpx.HTTPError:
+            record_proxy_result(client_proxies, time.perf_counter() - start_time)
+            raise
+        record_proxy_result(
+            client_proxies, time.perf_counter() - start_time, response.status_code
+        )
+        return response
 
-        response.raise_for_status()
+    async def send() -> httpx.Response:
+        """Send a single request, hedged through another proxy session if it is slow"""
+        await governor.acquire_async()
+
+        logger.info(f"Requesting URI: {URI}")
+        backup = None
+        if hedge_budget > 0:
+            backup_proxies = get_alternative_proxies(proxies)
+            if backup_proxies is not None:
+                backup = functools.partial(get, backup_proxies)
+
+        response = await request_hedger.run(
+            functools.partial(get, proxies), backup, hedge_budget
+        )
+        governor.update_from_headers(response.headers)
 
         return response
 
+    response = await send_with_retry_async(
+        send, urlparse(base_url).netloc, proxy_session_id(proxies), retry_policy
+    )
+
+    response.raise_for_status()
+
+    return response
+
+
+@flow  # Subflow (2nd level)
+async def close_http_clients():
+    """Close pooled HTTP clients once all requests of a flow run have been made"""
+    await close_async_clients()
+
 
 @task(
     retries=3,
@@ -170,7 +273,13 @@ def upload_file_to_gcs_bucket(
     file_name: str,
     file_extension: str,
     folder: str = None,
+    skip_unchanged: bool = True,
 ) -> str:
+    """Upload contents as blob to Google Cloud Storage Bucket
+
+    With `skip_unchanged` the upload is skipped if the stored object has the same checksum
+    (e.g. on retries and re-runs).
+    """
     logger = get_run_logger()
 
     if folder is None:
@@ -178,15 +287,259 @@ def upload_file_to_gcs_bucket(
     else:
         blob_name = f"{folder}/{file_name}.{file_extension}"
 
-    blob = upload_blob_from_memory(
-        bucket_name, contents, blob_name, gcp_credential_block_name
-    )
+    if not skip_unchanged:
+        blob = upload_blob_from_memory(
+            bucket_name, contents, blob_name, gcp_credential_block_name
+        )
+    else:
+        blob, uploaded = upload_blob_from_memory_if_changed(
+            bucket_name, contents, blob_name, gcp_credential_block_name
+        )
+        if not uploaded:
+            logger.info(f"Skipped upload of {blob.name}: unchanged in {bucket_name}")
+            return blob.name
 
     logger.info(f"Uploaded {blob}: {blob.name} to {bucket_name}")
 
     return blob.name
 
 
+@task(retries=3, retry_delay_seconds=3, timeout_seconds=300)
+def bulk_upload_files_to_gcs_bucket(
+    gcp_credential_block_name: str,
+    bucket_name: str,
+    blobs: list[tuple[str, bytes]],
+    skip_unchanged: bool = True,
+    codec: Literal["gzip", "zstd"] = None,
+    max_workers: int = BULK_UPLOAD_MAX_WORKERS,
+) -> BulkUploadResult:
+    """Upload many `(blob name, contents)` to Google Cloud Storage Bucket as one task
+
+    Blobs are uploaded by a bounded pool of workers sharing one client, instead of one task (and
+    thread) per blob. Failed blobs are reported in the result. The task is only retried if no
+    blob could be stored at all.
+    """
+    logger = get_run_logger()
+
+    result = upload_blobs_from_memory(
+        bucket_name,
+        blobs,
+        gcp_credential_block_name,
+        skip_unchanged=skip_unchanged,
+        codec=codec,
+        max_workers=max_workers,
+    )
+
+    logger.info(
+        f"Uploaded {len(result.uploaded)}, skipped {len(result.skipped)} unchanged and failed to upload {len(result.failed)} blobs to {bucket_name}"
+    )
+    for blob_name, error in result.failed.items():
+        logger.warning(f"Upload of {blob_name} failed: {error}")
+
+    if len(result.failed) > 0 and len(result.stored) == 0:
+        raise RuntimeError(f"Failed to upload all {len(result.failed)} blobs")
+
+    return result
+
+
+def _stream_file_to_gcs_bucket(
+    logger,
+    http: requests.Session,
+    gcp_credential_block_name: str,
+    bucket_name: str,
+    endpoint: str,
+    blob_name: str,
+    proxies: dict,
+    headers: dict,
+    params: dict,
+    base_url: str,
+    chunk_size: int,
+    retry_policy: RetryPolicy,
+    timeout: tuple[float, float],
+) -> requests.Response | None:
+    """Stream a single file into a blob (None if it is stored already), see `stream_file_to_gcs_bucket`"""
+
+    existing_blob = get_bucket(bucket_name, gcp_credential_block_name).get_blob(
+        blob_name
+    )
+    if existing_blob is not None:
+        logger.info(f"Skipped download of {blob_name}: stored in {bucket_name}")
+        upload_stats.record(existing_blob.size or 0, skipped=True)
+        return None
+
+    URI = base_url + endpoint
+
+    def send() -> requests.Response:
+        """Send a single request (the body is read later, chunk by chunk)"""
+        logger.info(f"Streaming {URI} to {bucket_name}/{blob_name}")
+        start_time = time.perf_counter()
+        try:
+            response = http.get(
+                url=URI,
+                params=params,
+                proxies=proxies,
+                verify=False,
+                headers=headers,
+                stream=True,
+                timeout=timeout,
+            )
+        except requests.RequestException:
+            record_proxy_result(proxies, time.perf_counter() - start_time)
+            raise
+        record_proxy_result(
+            proxies, time.perf_counter() - start_time, response.status_code
+        )
+
+        return response
+
+    # One slot for the download and the upload socket (see `DescriptorLimiter`)
+    with descriptor_limiter.slot():
+        response = send_with_retry(
+            send, urlparse(base_url).netloc, proxy_session_id(proxies), retry_policy
+        )
+
+        with response:
+            response.raise_for_status()
+
+            blob = upload_blob_from_stream(
+                bucket_name,
+                response.iter_content(chunk_size=chunk_size),
+                blob_name,
+                gcp_credential_block_name,
+                chunk_size=chunk_size,
+                content_type=response.headers.get("Content-Type"),
+            )
+
+    logger.info(f"Uploaded {blob}: {blob.name} to {bucket_name}")
+
+    return response
+
+
+@task(timeout_seconds=90)
+def stream_file_to_gcs_bucket(
+    gcp_credential_block_name: str,
+    bucket_name: str,
+    endpoint: str,
+    file_name: str,
+    file_extension: str,
+    folder: str = None,
+    proxies: dict = None,
+    headers: dict = None,
+    params: dict = None,
+    base_url: str = "https://images.unsplash.com",
+    chunk_size: int = RESUMABLE_UPLOAD_CHUNK_SIZE,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    timeout: tuple[float, float] = REQUEST_TIMEOUT_SECONDS,
+) -> tuple[str, requests.Response | None]:
+    """Stream a file from Unsplash straight into a Google Cloud Storage Bucket
+
+    The response body is piped chunk by chunk into a resumable upload, so memory usage is
+    bounded by `chunk_size` instead of the size of the file. Failed requests are retried
+    according to `retry_policy` (not by the task, which would multiply the attempts).
+
+    Files which are stored already aren't downloaded again (only the object metadata is
+    requested), the response is None then.
+    """
+    logger = get_run_logger()
+
+    if folder is None:
+        blob_name = f"{file_name}.{file_extension}"
+    else:
+        blob_name = f"{folder}/{file_name}.{file_extension}"
+
+    response = _stream_file_to_gcs_bucket(
+        logger,
+        requests,
+        gcp_credential_block_name,
+        bucket_name,
+        endpoint,
+        blob_name,
+        proxies,
+        headers,
+        params,
+        base_url,
+        chunk_size,
+        retry_policy,
+        timeout,
+    )
+
+    return blob_name, response
+
+
+@task(timeout_seconds=120)
+def bulk_stream_files_to_gcs_bucket(
+    gcp_credential_block_name: str,
+    bucket_name: str,
+    files: list[tuple[str, str]],
+    proxies: dict = None,
+    headers: dict = None,
+    params: dict = None,
+    base_url: str = "https://images.unsplash.com",
+    chunk_size: int = RESUMABLE_UPLOAD_CHUNK_SIZE,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    timeout: tuple[float, float] = REQUEST_TIMEOUT_SECONDS,
+    max_workers: int = BULK_UPLOAD_MAX_WORKERS,
+) -> dict[str, requests.Response | None]:
+    """Stream many `(endpoint, blob name)` from Unsplash into a Google Cloud Storage Bucket as one task
+
+    Files are streamed by a bounded pool of workers (scaled to the file descriptors left), which
+    share one HTTP session and the cached storage client, instead of one task per file. Returns
+    the response of every stored file by blob name (None if it was stored already, see
+    `stream_file_to_gcs_bucket`). Failed files are logged, the task only fails if no file could
+    be stored at all.
+    """
+    logger = get_run_logger()
+
+    max_workers = descriptor_limiter.scale(max_workers)
+    http = requests.Session()
+    http.mount(
+        "https://",
+        requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers
+        ),
+    )
+
+    def stream(file: tuple[str, str]) -> requests.Response | None:
+        """Stream a single file"""
+        endpoint, blob_name = file
+        return _stream_file_to_gcs_bucket(
+            logger,
+            http,
+            gcp_credential_block_name,
+            bucket_name,
+            endpoint,
+            blob_name,
+            proxies,
+            headers,
+            params,
+            base_url,
+            chunk_size,
+            retry_policy,
+            timeout,
+        )
+
+    responses = {}
+    failed = {}
+    with http, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(stream, file): file[1] for file in files}
+        for future, blob_name in futures.items():
+            try:
+                responses[blob_name] = future.result()
+            except Exception as e:
+                failed[blob_name] = repr(e)
+
+    logger.info(
+        f"Streamed {len(responses)} of {len(files)} files to {bucket_name} ({upload_stats.metrics()})"
+    )
+    for blob_name, error in failed.items():
+        logger.warning(f"Streaming {blob_name} failed: {error}")
+
+    if len(failed) > 0 and len(responses) == 0:
+        raise RuntimeError(f"Failed to stream all {len(failed)} files")
+
+    return responses
+
+
 @task(retries=3, retry_delay_seconds=10)
 def parse_response(response: requests.Response) -> dict:
     """Convert Response to Dict"""
@@ -202,58 +555,64 @@ def parse_response(response: requests.Response) -> dict:
 
 
 @task(retries=3, retry_delay_seconds=10)
-def response_data_to_df(response_json: dict, response_data_name: str) -> pd.DataFrame:
-    """Store Response data as in Dataframe"""
+def response_data_to_df(
+    response_json: dict,
+    response_data_name: str,
+    schema: pa.Schema = None,
+    flatten: bool = False,
+    max_level: int = None,
+) -> pd.DataFrame:
+    """Store Response data as in Dataframe
+
+    The Dataframe is built directly from the parsed response, optionally with an explicit Arrow
+    `schema` or with nested objects flattened into columns (see `src.etl.transform.records_to_df`).
+    """
 
     logger = get_run_logger()
+    logger.info(f"Converting {response_data_name} data to Dataframe")
+
+    if isinstance(response_json, dict):
+        records = [response_json]  # A single object becomes a single row
+    elif isinstance(response_json, list) and all(
+        isinstance(item, dict) for item in response_json
+    ):
+        records = response_json
+    else:
+        raise ValueError(f"No parsing method for {type(response_json)} implemented")
 
-    with NamedTemporaryFile(delete=True, suffix=".jsonl") as temp_file:
-        logger.info(f"Writing {response_data_name} data to file {temp_file.name}")
-
-        if isinstance(response_json, list):
-            if isinstance(response_json[0], dict):
-                for item in response_json:
-                    item_string = json.dumps(item) + "\n"
-                    temp_file.write(item_string.encode())
-
-                df = pd.read_json(temp_file.name, lines=True)
-
-        elif isinstance(response_json, dict):
-            data = {
-                k: [v] for k, v in response_json.items()
-            }  # Dataframe expects {'key1': ['value1], 'key2': ['value2]}
-            df = pd.DataFrame(data)
-
-        else:
-            raise ValueError(f"No parsing method for {type(response_json)} implemented")
+    df = records_to_df(records, schema, flatten, max_level)
 
-        df["requested_data_at"] = datetime.datetime.now()
-        logger.info(
-            f"The Dataframe contains {df.shape[1]} columns and {df.shape[0]} rows"
-        )
+    df["requested_data_at"] = datetime.datetime.now()
+    logger.info(f"The Dataframe contains {df.shape[1]} columns and {df.shape[0]} rows")
 
     return df
 
 
 @task(retries=3, retry_delay_seconds=10)
 def store_response_df_to_gcs_bucket(
-    df: pd.DataFrame, response_data_name: str, env: str = "dev"
+    df: pd.DataFrame,
+    response_data_name: str,
+    env: str = "dev",
+    compression: Literal["snappy", "gzip", "zstd", "none"] = "snappy",
+    row_group_size: int = None,
 ) -> storage.blob.Blob:
-    """Store Dataframe as Blob in Google Cloud Storage Bucket"""
-    logger = get_run_logger()
+    """Store Dataframe as Blob in Google Cloud Storage Bucket
 
-    with NamedTemporaryFile(delete=True, suffix=".parquet") as temp_parquet:
-        df.to_parquet(temp_parquet.name)
+    The Parquet file is built in memory (large Dataframes are streamed row group by row group).
+    """
+    logger = get_run_logger()
 
-        today = datetime.date.today().strftime("%Y%m%d")
-        blob_name = f"{response_data_name}_{today}.parquet"
-        blob = upload_blob_from_file(
-            bucket_name=f"unsplash-{response_data_name}-{env}",
-            source_file_name=temp_parquet.name,
-            destination_blob_name=blob_name,
-            gcp_credential_block_name="unsplash-photo-trends-deployment-sa",
-        )
+    today = datetime.date.today().strftime("%Y%m%d")
+    blob_name = f"{response_data_name}_{today}.parquet"
+    blob = upload_dataframe_as_parquet(
+        bucket_name=f"unsplash-{response_data_name}-{env}",
+        df=df,
+        destination_blob_name=blob_name,
+        gcp_credential_block_name="unsplash-photo-trends-deployment-sa",
+        compression=compression,
+        row_group_size=row_group_size,
+    )
 
-        logger.info(f"Uploaded topics data to {blob}")
+    logger.info(f"Uploaded topics data to {blob}")
 
-        return blob
+    return blob
@@ -1,6 +1,7 @@
 """ Flow to request https://api.unsplash.com/stats/month/ Endpoint """
 
-from prefect import flow
+from prefect import flow, get_run_logger
+from src.network.conditional import ResponseValidatorCache
 from src.prefect.generic_tasks import (
     parse_response,
     request_unsplash_api,
@@ -10,30 +11,53 @@ from src.prefect.generic_tasks import (
 from src.utils import load_env_variables
 
 
-# Subflow
-@flow(retries=3, retry_delay_seconds=10)
-def request_monthly_platform_stats() -> list[dict]:
+# Subflow (requests are retried by `request_unsplash_api`)
+@flow
+def request_monthly_platform_stats(headers: dict = None) -> list[dict]:
     """Request monthly platform statistics (e.g. number of photos or downloads) from Unsplash API"""
 
     endpoint = "/stats/month/"
-    response = request_unsplash_api(endpoint=endpoint)
+    response = request_unsplash_api(endpoint=endpoint, headers=headers)
 
     return response
 
 
 @flow
 def ingest_monthly_platform_stats_gcs():
-    """Flow to load monthly stats from unsplash and store them in a Google Cloud Storage Bucket"""
+    """Flow to load monthly stats from unsplash and store them in a Google Cloud Storage Bucket
+
+    Stats are only stored if they changed since the last run (conditional request).
+    """
     # Call the function with the directory you want to start from
 
-    response = request_monthly_platform_stats()
-    response_json = parse_response(response)
+    logger = get_run_logger()
+
     env_variables = load_env_variables()
     env = env_variables["ENV"]  # dev, test or prod
 
+    validator_cache = ResponseValidatorCache.from_gcs_blob(
+        bucket_name=f"unsplash-monthly-platform-stats-{env}",
+        blob_name="_response_validators.json",
+        gcp_credential_block_name="unsplash-photo-trends-deployment-sa",
+    )
+
+    response = request_monthly_platform_stats(
+        headers=validator_cache.request_headers("monthly-platform-stats")
+    )
+    if validator_cache.is_unchanged("monthly-platform-stats", response):
+        logger.info(
+            "Monthly platform stats didn't change since last run. Nothing to store"
+        )
+        return
+
+    response_json = parse_response(response)
+
     df = response_data_to_df(response_json, "monthly-platform-stats")
     store_response_df_to_gcs_bucket(df, "monthly-platform-stats", env)
 
+    validator_cache.update("monthly-platform-stats", response)
+    validator_cache.save()
+
 
 if __name__ == "__main__":
     ingest_monthly_platform_stats_gcs()
@@ -5,19 +5,26 @@ import asyncio
 import datetime
 from typing import Literal
 
-from prefect_gcp.bigquery import bigquery_insert_stream, bigquery_query
 from prefect_gcp.credentials import GcpCredentials
 
 from prefect import flow, get_run_logger
 from src.data_types import PhotoEditorialMetadataExpanded
 from src.decoder import datetime_decoder
-from src.prefect.generic_tasks import (
-    create_random_ua_string,
-    prepare_proxy_adresses,
-    request_unsplash_api_async,
-)
+from src.etl.bigquery_jobs import load_rows
+from src.etl.clients import get_bigquery_read_client
+from src.etl.extract import query_record_batches
+from src.etl.index import PhotoIdIndex
+from src.etl.state import IngestionState
+from src.network.descriptors import descriptor_limiter, raise_descriptor_limit
+from src.network.hedging import request_hedger
+from src.network.proxies import get_proxies
+from src.network.useragents import random_useragent
+from src.prefect.generic_tasks import close_http_clients, request_unsplash_api_async
 from src.utils import load_env_variables, timer
 
+# Local state of the requested photos, next to the photo metadata
+STATE_BLOB_NAME = "state/metadata-expanded.sqlite.gz"
+
 
 @flow(
     retries=3,
@@ -35,8 +42,15 @@ def get_requested_photos_from_logs(
             FROM `unsplash-photo-trends.{env}.photos-editorial-metadata-expanded-request-log`
         """
 
-    results = bigquery_query(query, gcp_credentials, location=location)
-    results = [result[0] for result in results]
+    bigquery_client = gcp_credentials.get_bigquery_client(location=location)
+    bqstorage_client = get_bigquery_read_client(gcp_credentials)
+    results = [
+        photo_id
+        for batch in query_record_batches(
+            bigquery_client, query, bqstorage_client=bqstorage_client
+        )
+        for photo_id in batch.column(0).to_pylist()
+    ]
 
     logger.info(
         f"Already requested expanded metadata for {len(results)} photos in previous runs"
@@ -47,11 +61,21 @@ def get_requested_photos_from_logs(
 
 @flow(timeout_seconds=120)  # Subflow (2nd level)
 async def request_unsplash_api(
-    batch: list[str], proxies: dict = None, headers: dict = None, params: dict = None
+    batch: list[str],
+    proxies: dict = None,
+    headers: dict = None,
+    params: dict = None,
+    hedge_budget: float = 0.0,
 ):
+    """Asynchronously request expanded metadata for a batch of photos
+
+    Slow requests are hedged through another proxy session (up to `hedge_budget` of all requests).
+    """
     endpoints = [f"/photos/{photo_id}" for photo_id in batch]
     tasks = [
-        request_unsplash_api_async(endpoint, proxies, headers, params)
+        request_unsplash_api_async(
+            endpoint, proxies, headers, params, hedge_budget=hedge_budget
+        )
         for endpoint in endpoints
     ]
     responses = await asyncio.gather(*tasks, return_exceptions=True)
@@ -66,23 +90,20 @@ def write_photo_metadata_expanded_to_bigquery(
     env: str = "dev",
     location="europe-west3",
 ):
-    """Write expanded photo metadata to Bigquery"""
+    """Write expanded photo metadata to Bigquery (one load job)"""
 
     logger = get_run_logger()
 
-    results = bigquery_insert_stream(
-        env,
-        "photos-editorial-metadata-expanded",
-        records,
-        gcp_credentials,
-        location=location,
+    bigquery_client = gcp_credentials.get_bigquery_client(location=location)
+    loaded_rows = load_rows(
+        bigquery_client, env, "photos-editorial-metadata-expanded", records
     )
 
     logger.info(
-        f"Wrote {len(records)} rows to table 'unsplash-photo-trends.{env}.photos-editorial-metadata-expanded'"
+        f"Loaded {loaded_rows} rows into table 'unsplash-photo-trends.{env}.photos-editorial-metadata-expanded'"
     )
 
-    return results
+    return loaded_rows
 
 
 @flow(retries=3, retry_delay_seconds=10)  # Subflow (2nd level)
@@ -92,34 +113,52 @@ def write_request_log_to_bigquery(
     env: str = "dev",
     location="europe-west3",
 ):
-    """Write for which URLs metadata has been requested and stored in Bigquery"""
+    """Write for which URLs metadata has been requested and stored in Bigquery (one load job)"""
 
     logger = get_run_logger()
 
-    results = bigquery_insert_stream(
-        env,
-        "photos-editorial-metadata-expanded-request-log",
-        records,
-        gcp_credentials,
-        location=location,
+    bigquery_client = gcp_credentials.get_bigquery_client(location=location)
+    loaded_rows = load_rows(
+        bigquery_client, env, "photos-editorial-metadata-expanded-request-log", records
     )
 
     logger.info(
-        f"Wrote {len(records)} rows to table 'unsplash-photo-trends.{env}.photos-editorial-metadata-expanded-request-log'"
+        f"Loaded {loaded_rows} rows into table 'unsplash-photo-trends.{env}.photos-editorial-metadata-expanded-request-log'"
     )
 
-    return results
+    return loaded_rows
 
 
-@flow(timeout_seconds=180)  # Main Flow (1st level) # Main Flow (1st level)
+@flow  # Main Flow (1st level)
 @timer
 def ingest_photos_expanded_napi_bigquery(
     gcp_credential_block_name: str,
     proxy_type: Literal["datacenter", "residential"],
     batch_size: int = 30,
     total_record_size: int = 300,
+    hedge_budget: float = 0.1,
+    rebuild_index: bool = False,
+    flush_rows: int = 300,
+    reconcile_interval_hours: float = 24,
 ):
-    """Flow to load editorial photo metadata from Unsplash and store them in Bigquery"""
+    """Flow to load editorial photo metadata from Unsplash and store them in Bigquery
+
+    A run requests up to `total_record_size` photos (all remaining ones if None). Concurrent
+    requests are limited by the file descriptors left (see `src.network.descriptors`), and each
+    batch is bounded by the timeout of its subflow instead of the whole run.
+
+    `hedge_budget` is the share of requests which may be duplicated through another proxy
+    session when they are slow (0 disables hedging).
+
+    Known photo ids are kept in an index next to the photos (see `src.etl.index`), so a run only
+    lists new manifests. Requested photo ids are kept in a local state (see `src.etl.state`), the
+    request log is only read to reconcile it every `reconcile_interval_hours` (and with
+    `rebuild_index`).
+
+    Metadata and log records are buffered and written with one load job each per `flush_rows`
+    records (instead of a streaming insert per batch). Photos are marked as processed in the state
+    only once their records have been written.
+    """
 
     logger = get_run_logger()
 
@@ -131,38 +170,44 @@ def ingest_photos_expanded_napi_bigquery(
     # Init all credentials
     gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
 
-    # Get all Photos
-    storage_client = gcp_credentials.get_cloud_storage_client()
-    logger.info(f"Collecting blobs from bucket '{source_bucket_name}'")
-    blobs = storage_client.list_blobs(source_bucket_name, page_size=10000)
-    pages = blobs.pages
-    photo_ids = []
-    for idx, page in enumerate(pages):
-        blob_names = [str(blob.name).split(".")[0] for blob in page]
-        photo_ids.extend(blob_names)
-        logger.info(f"Collected blobs from page {idx+1}")
-    logger.info(f"{len(photo_ids)} Photos stored in {source_bucket_name}")
+    # Allow as many open sockets as the system permits
+    descriptor_limit = raise_descriptor_limit()
+    logger.info(f"File descriptor limit: {descriptor_limit}")
 
-    # Get all previously requested photos (where expanded photo metadata is available)
-    requested_photo_ids = get_requested_photos_from_logs(gcp_credentials, env)
+    # Get all Photos (only manifests newer than the watermark of the index are read)
+    logger.info(f"Updating photo id index of bucket '{source_bucket_name}'")
+    index = PhotoIdIndex.from_gcs_blob(source_bucket_name, gcp_credential_block_name)
+    if rebuild_index:
+        index.reset()
+    new_photos = index.update_from_bucket(source_bucket_name, gcp_credential_block_name)
     logger.info(
-        f"{len(requested_photo_ids)} Photos with expanded metadata written to 'photos-editorial-metadata-expanded-request-log'"
+        f"{new_photos} new photos since last run, {len(index.known)} Photos stored in {source_bucket_name}"
+    )
+    index.save()
+
+    # Get all previously requested photos (where expanded photo metadata is available)
+    state = IngestionState.from_gcs_blob(
+        source_bucket_name, gcp_credential_block_name, STATE_BLOB_NAME
     )
+    if rebuild_index or state.needs_reconcile(
+        "metadata", datetime.timedelta(hours=reconcile_interval_hours)
+    ):
+        requested_photo_ids = get_requested_photos_from_logs(gcp_credentials, env)
+        logger.info(
+            f"{len(requested_photo_ids)} Photos with expanded metadata written to 'photos-editorial-metadata-expanded-request-log'"
+        )
+        state.reconcile_processed("metadata", requested_photo_ids)
+        state.save()
 
-    # Compare both lists and get photo id that need to be requested
-    remaining_photo_ids = list(set(photo_ids).difference(set(requested_photo_ids)))
+    # Photos that need to be requested
+    remaining_photo_ids = state.pending("metadata", index.known)
     logger.info(
         f"{len(remaining_photo_ids)} Photos still need to requested from https://unsplash.com/napi/photos/<photo_id> "
     )
 
-    # Prepare Proxy and Useragent
-    proxies = prepare_proxy_adresses(proxy_type)
-    proxies["http://"] = proxies["http"]
-    proxies["https://"] = proxies["https"]
-    proxies.pop("http")
-    proxies.pop("https")
-
     # Split request load in batches
+    if total_record_size is None:
+        total_record_size = len(remaining_photo_ids)
     remaining_photo_ids = remaining_photo_ids[0:total_record_size]
     batches = [
         remaining_photo_ids[i : i + batch_size]
@@ -177,15 +222,38 @@ def ingest_photos_expanded_napi_bigquery(
 
     total_records_written = 0
 
-    while len(remaining_photo_ids) > 0 and total_records_written < total_record_size:
-        # Request and write data
+    # Records are buffered across batches and written with one load job per table
+    buffered_photo_metadata = []
+    buffered_request_log = []
 
+    def flush_buffered_records():
+        """Write buffered records (metadata before its log) and mark their photos as processed"""
+        if len(buffered_photo_metadata) > 0:
+            write_photo_metadata_expanded_to_bigquery(
+                gcp_credentials, buffered_photo_metadata, env
+            )
+        if len(buffered_request_log) > 0:
+            write_request_log_to_bigquery(gcp_credentials, buffered_request_log, env)
+            state.mark_processed(
+                "metadata", (record["photo_id"] for record in buffered_request_log)
+            )
+            state.save()
+        buffered_photo_metadata.clear()
+        buffered_request_log.clear()
+
+    # Requested records are written even if the run fails (e.g. a batch times out)
+    try:
         for batch in batches:
-            useragent_string = create_random_ua_string()
+            # Prepare Proxy (healthiest pooled session) and Useragent
+            proxies = get_proxies(proxy_type, httpx_format=True)
+            useragent_string = random_useragent()
             logger.info(f"Will be using '{useragent_string}' to make next requests")
             headers = {"User-Agent": useragent_string}  # Overwrite Useragent
 
-            responses = request_unsplash_api(batch, proxies, headers)
+            responses = request_unsplash_api(
+                batch, proxies, headers, hedge_budget=hedge_budget
+            )
+            logger.info(f"Hedged requests: {request_hedger.metrics()}")
 
             # Write photo metadata records to Bigquery
             records_photo_metadata = []
@@ -214,9 +282,7 @@ def ingest_photos_expanded_napi_bigquery(
                 logger.info("Didn't collect any metadata. Moving on to new batch")
                 continue
 
-            write_photo_metadata_expanded_to_bigquery(
-                gcp_credentials, records_photo_metadata, env
-            )
+            buffered_photo_metadata.extend(records_photo_metadata)
 
             # Log written records to Bigquery
             request_log_records = []
@@ -241,22 +307,29 @@ def ingest_photos_expanded_napi_bigquery(
                 except Exception as e:
                     logger.error(f"Exception occured: {e}")
 
-            write_request_log_to_bigquery(gcp_credentials, request_log_records, env)
+            buffered_request_log.extend(request_log_records)
+            if len(buffered_photo_metadata) >= flush_rows:
+                flush_buffered_records()
 
             total_records_written += batch_size
             logger.info(
-                f"Batch processed: {batch_size} metadata (and log) records written to Bigquery"
+                f"Batch processed: {batch_size} metadata (and log) records buffered for Bigquery"
             )
             logger.info(
-                f"In this run: {total_records_written} metadata (and log) records written to Bigquery"
+                f"In this run: {total_records_written} metadata (and log) records requested"
             )
 
-            if total_records_written == 300:
+            if total_records_written >= total_record_size:
                 logger.info(f"Job finished")
                 logger.info(
                     f"All ({total_record_size}) metadata (and log) records written to Bigquery"
                 )
                 break
+    finally:
+        flush_buffered_records()
+
+    close_http_clients()
+    logger.info(f"File descriptors: {descriptor_limiter.metrics()}")
 
 
 if __name__ == "__main__":
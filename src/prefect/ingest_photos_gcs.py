@@ -3,62 +3,94 @@
 import datetime
 from typing import Literal
 
-from prefect_gcp.bigquery import bigquery_insert_stream, bigquery_query
+import requests
+from google.cloud import bigquery
 from prefect_gcp.credentials import GcpCredentials
 
 import prefect
 from prefect import flow, get_run_logger
 from prefect.task_runners import ConcurrentTaskRunner
+from src.etl.bigquery_jobs import load_rows
+from src.etl.clients import get_bigquery_read_client
+from src.etl.extract import pending_work_query, query_record_batches
+from src.etl.load import upload_stats
+from src.etl.state import IngestionState
+from src.network.descriptors import raise_descriptor_limit
+from src.network.proxies import get_proxies
+from src.network.useragents import random_useragent
 from src.prefect.generic_tasks import (
-    create_random_ua_string,
-    prepare_proxy_adresses,
+    bulk_stream_files_to_gcs_bucket,
+    bulk_upload_files_to_gcs_bucket,
     request_unsplash_api,
-    upload_file_to_gcs_bucket,
 )
 from src.utils import load_env_variables
 
+# Local state of the downloaded photos, next to the photos
+STATE_BLOB_NAME = "state/downloads.sqlite.gz"
+
 
 @flow(retries=3, retry_delay_seconds=5, timeout_seconds=90)  # Subflow (2nd level)
-def get_downloadable_photos_from_logs(
+def get_downloaded_photos_from_logs(
     gcp_credentials: GcpCredentials, env: str = "dev", location="europe-west3"
-) -> list[tuple]:
-    """Get all photos which have can be requested and downloaded"""
+) -> list[str]:
+    """Get all photos which have been downloaded and logged in Bigquery already"""
 
     logger = get_run_logger()
 
     query = f"""
-            SELECT photo_id, urls.full, created_at
-            FROM `unsplash-photo-trends.{env}.photos-editorial-metadata-expanded`
-            ORDER BY created_at asc
-            """
-
-    results = bigquery_query(query, gcp_credentials, location=location)
-    results = [(result[0], result[1], result[2]) for result in results]
+            SELECT DISTINCT photo_id
+            FROM `unsplash-photo-trends.{env}.photos-editorial-download-log`
+        """
+
+    bigquery_client = gcp_credentials.get_bigquery_client(location=location)
+    bqstorage_client = get_bigquery_read_client(gcp_credentials)
+    results = [
+        photo_id
+        for batch in query_record_batches(
+            bigquery_client, query, bqstorage_client=bqstorage_client
+        )
+        for photo_id in batch.column(0).to_pylist()
+    ]
 
-    logger.info(f"There are {len(results)} photos available for download")
+    logger.info(f"Downloaded {len(results)} photos in previous runs")
 
     return results
 
 
 @flow(retries=3, retry_delay_seconds=5, timeout_seconds=90)  # Subflow (2nd level)
-def get_downloaded_photos_from_logs(
-    gcp_credentials: GcpCredentials, env: str = "dev", location="europe-west3"
-) -> int:
-    """Get all photos which have been requested and stored in GCS alrady"""
+def get_pending_photos_from_logs(
+    gcp_credentials: GcpCredentials,
+    limit: int,
+    env: str = "dev",
+    location="europe-west3",
+) -> list[tuple]:
+    """Get the oldest photos which can be downloaded but haven't been downloaded yet
+
+    The comparison with the download log, the ordering and the limit are done in Bigquery, so
+    only the photos of this run are transferred. The result is read as Arrow record batches and
+    converted column by column.
+    """
 
     logger = get_run_logger()
 
-    query = f"""
-            SELECT photo_id
-            FROM `unsplash-photo-trends.{env}.photos-editorial-download-log`
-            """
+    query = pending_work_query(
+        source_table=f"unsplash-photo-trends.{env}.photos-editorial-metadata-expanded",
+        processed_table=f"unsplash-photo-trends.{env}.photos-editorial-download-log",
+        key_column="photo_id",
+        columns=["photo_id", "urls.full", "created_at"],
+        order_by="created_at",
+    )
+    query_parameters = [bigquery.ScalarQueryParameter("limit", "INT64", limit)]
 
-    results = bigquery_query(query, gcp_credentials, location=location)
-    results = [result[0] for result in results]
+    bigquery_client = gcp_credentials.get_bigquery_client(location=location)
+    bqstorage_client = get_bigquery_read_client(gcp_credentials)
+    results = []
+    for batch in query_record_batches(
+        bigquery_client, query, query_parameters, bqstorage_client=bqstorage_client
+    ):
+        results.extend(zip(*(column.to_pylist() for column in batch.columns)))
 
-    logger.info(
-        f"{len(results)} photos have been downloaded and stored in previous run"
-    )
+    logger.info(f"There are {len(results)} photos pending for download in this run")
 
     return results
 
@@ -95,33 +127,74 @@ def request_photos(
     return photos
 
 
-@flow(timeout_seconds=120, task_runner=ConcurrentTaskRunner())  # Subflow (2nd level)
+@flow(timeout_seconds=300)  # Subflow (2nd level)
 def upload_files_to_gcs_bucket(
     photos: list[tuple],
     gcp_credential_block_name: str,
     bucket_name: str,
     file_extension: str,
-) -> list[tuple[str, prefect.futures.PrefectFuture]]:
-    """Upload photos to GCS"""
+) -> list[tuple[str, str]]:
+    """Upload photos to GCS (in one bulk upload) and return photo id and blob name of stored photos"""
     logger = get_run_logger()
 
     logger.info("Starting to upload photos to GCS")
 
+    blob_names = {}
     blobs = []
     for photo in photos:
-        future = upload_file_to_gcs_bucket.submit(
-            gcp_credential_block_name,
-            bucket_name,
-            photo[2],  # photo as bytes
-            photo[0],  # photo id
-            file_extension,
-            f"{photo[1].year}-{photo[1].month}",  # created at
-        )
-        blobs.append((photo[0], future))
+        folder = f"{photo[1].year}-{photo[1].month}"  # created at
+        blob_name = f"{folder}/{photo[0]}.{file_extension}"
+        blob_names[blob_name] = photo[0]  # photo id
+        blobs.append((blob_name, photo[2]))  # photo as bytes
+
+    result = bulk_upload_files_to_gcs_bucket(
+        gcp_credential_block_name, bucket_name, blobs
+    )
+
+    return [(blob_names[blob_name], blob_name) for blob_name in result.stored]
 
-    blobs = [(b[0], b[1]) for b in blobs if b[1].wait().is_completed()]
 
-    return blobs
+@flow(timeout_seconds=150)  # Subflow (2nd level)
+def stream_photos_to_gcs_bucket(
+    batch: list[tuple[str, str, datetime.datetime]],
+    gcp_credential_block_name: str,
+    bucket_name: str,
+    file_extension: str,
+    proxies: dict = None,
+    headers: dict = None,
+    base_url: str = "https://images.unsplash.com",
+) -> list[tuple[str, datetime.datetime, requests.Response | None]]:
+    """Stream photos from Unsplash straight into GCS (without holding them in memory)
+
+    The whole batch is streamed by one task (see `bulk_stream_files_to_gcs_bucket`) instead of
+    a task per photo. Photos stored already aren't downloaded again, their response is None.
+    """
+
+    logger = get_run_logger()
+
+    logger.info("Starting to stream photos from Unsplash to GCS")
+
+    photos = {}  # By blob name
+    for photo in batch:
+        photo_id = photo[0]
+        created_at = photo[2]
+        blob_name = f"{created_at.year}-{created_at.month}/{photo_id}.{file_extension}"
+        photos[blob_name] = (photo_id, created_at, photo[1].replace(base_url, ""))
+
+    responses = bulk_stream_files_to_gcs_bucket(
+        gcp_credential_block_name,
+        bucket_name,
+        [(photo[2], blob_name) for blob_name, photo in photos.items()],
+        proxies,
+        headers,
+        None,
+        base_url,
+    )
+
+    return [
+        (photos[blob_name][0], photos[blob_name][1], response)
+        for blob_name, response in responses.items()
+    ]
 
 
 @flow(retries=3, retry_delay_seconds=3)  # Subflow (2nd level)
@@ -135,19 +208,16 @@ def write_download_log_to_bigquery(
 
     logger = get_run_logger()
 
-    results = bigquery_insert_stream(
-        env,
-        "photos-editorial-download-log",
-        records,
-        gcp_credentials,
-        location=location,
+    bigquery_client = gcp_credentials.get_bigquery_client(location=location)
+    loaded_rows = load_rows(
+        bigquery_client, env, "photos-editorial-download-log", records
     )
 
     logger.info(
-        f"Wrote {len(records)} rows to table 'unsplash-photo-trends.{env}.photos-editorial-download-log'"
+        f"Loaded {loaded_rows} rows into table 'unsplash-photo-trends.{env}.photos-editorial-download-log'"
     )
 
-    return results
+    return loaded_rows
 
 
 @flow(timeout_seconds=600)
@@ -156,8 +226,21 @@ def ingest_photos_gcs(
     proxy_type: Literal["datacenter", "residential"],
     batch_size: int,
     total_record_size: int,
+    stream_photos: bool = True,
+    flush_rows: int = 300,
+    reconcile_interval_hours: float = 24,
 ):
-    """Flow to download photos from unsplash and store them in Google Cloud Storage Bucket"""
+    """Flow to download photos from unsplash and store them in Google Cloud Storage Bucket
+
+    With `stream_photos` each photo is piped straight into a resumable GCS upload, so memory
+    usage no longer grows with `batch_size`.
+
+    Download log records are buffered and written with one load job per `flush_rows` records
+    (instead of a streaming insert per batch). Downloaded photos are kept in a local state (see
+    `src.etl.state`) once their log records have been written, so the state never runs ahead of
+    the download log. The state is reconciled with the download log every
+    `reconcile_interval_hours`.
+    """
 
     logger = get_run_logger()
     # logger.info(f"Platform information: \n{pformat(platform.uname()._asdict())}")
@@ -170,26 +253,42 @@ def ingest_photos_gcs(
     # Init all credentials
     gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
 
-    # Get all downloadable photos (Bigquery)
-    downloadable_photos = get_downloadable_photos_from_logs(gcp_credentials, env)
-    # Get already downloaded photos (Bigquery)
-    downloaded_photos = get_downloaded_photos_from_logs(gcp_credentials, env)
+    # Allow as many open sockets as the system permits
+    descriptor_limit = raise_descriptor_limit()
+    logger.info(f"File descriptor limit: {descriptor_limit}")
 
-    # Compare both
-    downloadable_photo_ids = [p[0] for p in downloadable_photos]
-    remaining_photo_ids = set(downloadable_photo_ids).difference(set(downloaded_photos))
+    bucket_name = f"photos-editorial-{env}"
+
+    # Photos downloaded in previous runs
+    state = IngestionState.from_gcs_blob(
+        bucket_name, gcp_credential_block_name, STATE_BLOB_NAME
+    )
+    if state.needs_reconcile(
+        "download", datetime.timedelta(hours=reconcile_interval_hours)
+    ):
+        downloaded_photo_ids = get_downloaded_photos_from_logs(gcp_credentials, env)
+        state.reconcile_processed("download", downloaded_photo_ids)
+        state.save()
+
+    # Get photos which haven't been downloaded yet (Bigquery). More photos than needed are
+    # requested, so photos excluded by the state (e.g. logged by a concurrent run after the
+    # query) don't take the places of pending ones.
+    remaining_photos = get_pending_photos_from_logs(
+        gcp_credentials, total_record_size + flush_rows, env
+    )
+    remaining_photos = [
+        photo
+        for photo in remaining_photos
+        if not state.is_processed("download", photo[0])
+    ][:total_record_size]
 
-    # Isolate remaining photos and create a smaller subset
-    remaining_photos = [p for p in downloadable_photos if p[0] in remaining_photo_ids][
-        0:total_record_size
-    ]
     # Split request load in batches
     batches = [
         remaining_photos[i : i + batch_size]
-        for i in range(0, len(remaining_photo_ids), batch_size)
+        for i in range(0, len(remaining_photos), batch_size)
     ]
 
-    if len(remaining_photo_ids) == 0:
+    if len(remaining_photos) == 0:
         logger.info(f"Job finished")
         logger.info(f"All ({total_record_size}) photos downloaded")
 
@@ -198,64 +297,93 @@ def ingest_photos_gcs(
     total_logged_records = 0
     total_records_iterated = 0
 
-    while len(remaining_photos) > 0 and total_records_iterated < total_record_size:
-        # Request and store photos
+    # Log records are buffered across batches and written with one load job
+    buffered_download_log = []
+
+    def flush_download_log():
+        """Write buffered log records to Bigquery and mark their photos as downloaded"""
+        if len(buffered_download_log) > 0:
+            write_download_log_to_bigquery(gcp_credentials, buffered_download_log, env)
+            state.mark_processed(
+                "download", (record["photo_id"] for record in buffered_download_log)
+            )
+            state.save()
+            buffered_download_log.clear()
+
+    # Downloaded photos are logged even if the run fails (e.g. a batch times out)
+    try:
         for batch in batches:
-            # Prepare Proxy and Useragent
-            proxies = prepare_proxy_adresses(proxy_type)
-            proxies["http://"] = proxies["http"]
-            proxies["https://"] = proxies["https"]
-            proxies.pop("http")
-            proxies.pop("https")
-
-            useragent_string = create_random_ua_string()
+            # Prepare Proxy and Useragent (photos are requested with `requests`, not `httpx`)
+            proxies = get_proxies(proxy_type)
+
+            useragent_string = random_useragent()
             logger.info(f"Will be using '{useragent_string}' to make next requests")
             headers = {"User-Agent": useragent_string}  # Overwrite Useragent
 
-            # Async - Request photos
-            photos = request_photos(batch, proxies, headers)
-            requested_photos = [
-                (p[0], p[1], p[2].result().content, p[2].result()) for p in photos
-            ]
+            if stream_photos:
+                # Async - Stream photos to Google Cloud Storage
+                streamed_photos = stream_photos_to_gcs_bucket(
+                    batch,
+                    gcp_credential_block_name,
+                    bucket_name,
+                    "jpg",
+                    proxies,
+                    headers,
+                )
+                requested_photos = [(p[0], p[1], None, p[2]) for p in streamed_photos]
+                uploaded_photos_ids = [p[0] for p in streamed_photos]
+            else:
+                # Async - Request photos
+                photos = request_photos(batch, proxies, headers)
+                requested_photos = [
+                    (p[0], p[1], p[2].result().content, p[2].result()) for p in photos
+                ]
+
+                # Async - Upload photos to Google Cloud Storage
+                blobs = upload_files_to_gcs_bucket(
+                    requested_photos, gcp_credential_block_name, bucket_name, "jpg"
+                )
+                uploaded_photos_ids = [b[0] for b in blobs]
+
             logger.info(
                 f"Requested Photos: \n{[(p[0], p[1]) for p in requested_photos]}"
             )
 
-            # Async - Upload photos to Google Cloud Storage
-            bucket_name = f"photos-editorial-{env}"
-            blobs = upload_files_to_gcs_bucket(
-                requested_photos, gcp_credential_block_name, bucket_name, "jpg"
-            )
-
             # Store all sucessfully uploaded photo ids
-            uploaded_photos_ids = [b[0] for b in blobs]
             logger.info(f"Photo IDs of uploaded photos: {uploaded_photos_ids}")
 
             # Log written records to Bigquery
             download_log_records = []
 
+            photo_urls = {photo[0]: photo[1] for photo in batch}
+
             for p in requested_photos:
                 photo_id = p[0]
                 response = p[3]
-                if response.status_code == 200 and photo_id in uploaded_photos_ids:
+                if response is None:
+                    # Stored by an earlier run, but not logged yet (not downloaded again)
+                    request_url = photo_urls[photo_id]
+                    request_id = None
+                elif response.status_code == 200 and photo_id in uploaded_photos_ids:
                     request_url = str(response.request.url)
                     request_id = response.headers["x-imgix-id"]
+                else:
+                    continue
 
-                    download_log_record = {
-                        "request_id": request_id,
-                        "request_url": request_url,
-                        "photo_id": photo_id,
-                        "requested_at": datetime.datetime.now().strftime(
-                            "%Y-%m-%d %H:%M:%S"
-                        ),
-                    }
+                download_log_record = {
+                    "request_id": request_id,
+                    "request_url": request_url,
+                    "photo_id": photo_id,
+                    "requested_at": datetime.datetime.now().strftime(
+                        "%Y-%m-%d %H:%M:%S"
+                    ),
+                }
 
-                    download_log_records.append(download_log_record)
+                download_log_records.append(download_log_record)
 
-            if len(download_log_records) > 0:
-                logged_records = write_download_log_to_bigquery(
-                    gcp_credentials, download_log_records, env
-                )
+            buffered_download_log.extend(download_log_records)
+            if len(buffered_download_log) >= flush_rows:
+                flush_download_log()
 
             total_requested_photos += len(requested_photos)
             total_uploaded_photos += len(uploaded_photos_ids)
@@ -271,11 +399,14 @@ def ingest_photos_gcs(
             logger.info(f"Uploaded photos (in run): {total_uploaded_photos}")
             logger.info(f"Records logged (in run): {total_logged_records}")
             logger.info(f"Records iterated (in run): {total_records_iterated}")
+            logger.info(f"Uploads (in run): {upload_stats.metrics()}")
 
             if total_records_iterated == total_record_size:
                 logger.info(f"Iterated trough all records ({total_record_size})")
                 logger.info("Job finished")
                 break
+    finally:
+        flush_download_log()
 
 
 if __name__ == "__main__":
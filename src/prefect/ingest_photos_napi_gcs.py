@@ -1,31 +1,39 @@
 """ Flow to request https://unsplash.com/napi/photos Endpoint (Backend API)"""
 
+import asyncio
+import datetime
 import json
 import math
-import time
-from datetime import timedelta
+import random
 from pprint import pformat
-from random import randint
 from typing import Literal
 
-from google.cloud import storage
+from google.cloud import bigquery
 from prefect_gcp.bigquery import bigquery_query
 from prefect_gcp.credentials import GcpCredentials
 
 from prefect import flow, get_run_logger, task
-from prefect.task_runners import ConcurrentTaskRunner
-from prefect.tasks import task_input_hash
-from src.etl.load import upload_blob_from_memory
+from src.etl.bigquery_jobs import merge_rows
+from src.etl.load import upload_stats
+from src.etl.shards import write_manifest, write_shard
+from src.etl.state import IngestionState
+from src.network.descriptors import descriptor_limiter, raise_descriptor_limit
+from src.network.proxies import get_proxies
+from src.network.useragents import random_useragent
 from src.prefect.generic_tasks import (
-    create_random_ua_string,
+    bulk_upload_files_to_gcs_bucket,
+    close_http_clients,
     parse_response,
-    prepare_proxy_adresses,
     request_unsplash_api,
+    request_unsplash_api_async,
 )
 from src.utils import load_env_variables
 
+# Local state of the requested pages, next to the photo metadata
+STATE_BLOB_NAME = "state/pages.sqlite.gz"
 
-@flow(retries=3, retry_delay_seconds=10)  # Subflow (2nd level)
+
+@flow  # Subflow (2nd level), retried by `request_unsplash_api`
 def request_first_page(
     params: dict = {"per_page": 30, "page": 1, "order_by": "oldest"}
 ):
@@ -39,59 +47,126 @@ def request_first_page(
     return response
 
 
-@task(
-    retries=3,
-    retry_delay_seconds=3,
-    cache_key_fn=task_input_hash,
-    cache_expiration=timedelta(hours=1),
-)  # Task (3rd level)
-def _upload_photo_metadata_as_blob(
-    response,
-    photo_metadata: dict,
-    gcp_credential_block_name: str,
-    bucket_name: str,
-) -> storage.blob.Blob:
-    """Upload single photo metadata as blob to Google Cloud Storage Bucket"""
+@flow(timeout_seconds=120)  # Subflow (2nd level)
+async def request_pages(
+    pages: list[int],
+    per_page: int,
+    proxy_type: Literal["datacenter", "residential"],
+    politeness_delay_seconds: float = 3,
+) -> list:
+    """Concurrently request pages of https://unsplash.com/napi/photos (each through its own proxy session)
 
-    logger = get_run_logger()
+    Responses (or exceptions) are returned in the same order as `pages`.
+    """
+
+    async def request_page(page: int):
+        """Request a single page after a random politeness delay"""
+        await asyncio.sleep(random.uniform(0, politeness_delay_seconds))
+
+        proxies = get_proxies(proxy_type, httpx_format=True)
+        headers = {"User-Agent": random_useragent()}  # Overwrite Useragent
+        params = {"per_page": per_page, "page": page, "order_by": "oldest"}
 
-    photo = {
+        return await request_unsplash_api_async("/photos", proxies, headers, params)
+
+    responses = await asyncio.gather(
+        *[request_page(page) for page in pages], return_exceptions=True
+    )
+
+    return responses
+
+
+def _photo_metadata_record(response, photo_metadata: dict) -> dict:
+    """Combine photo metadata with metadata of the request it was received with"""
+    return {
         "payload": photo_metadata,
         "request_metadata": {
             "requested_at": response.headers["Date"],
             "request_id": response.headers["X-Request-Id"],
-            "request_url": response.request.url,
+            "request_url": str(response.request.url),
         },
     }
 
-    photo_id = photo["payload"]["id"]
-    blob_name = f"{photo_id}.json"
-    bytes = json.dumps(photo).encode("utf-8")
-
-    logger.info(f"Uploading '{blob_name}' to {bucket_name}")
-    upload_blob_from_memory(bucket_name, bytes, blob_name, gcp_credential_block_name)
-
 
 @flow(
     retries=3,
     retry_delay_seconds=10,
     timeout_seconds=120,
-    task_runner=ConcurrentTaskRunner(),
 )  # Subflow (2nd level)
 def upload_photo_metadata_to_gcs(
     response,
     response_json: list[dict],
     gcp_credential_block_name: str,
     bucket_name: str,
+    page: int = None,
+    codec: Literal["gzip", "zstd"] = None,
 ):
-    """Asychronously upload photo metadata as blob to Google Cloud Storage Bucket"""
+    """Upload photo metadata as blob per photo to Google Cloud Storage Bucket (in one bulk upload)
+
+    With a `page`, the uploaded blobs are registered in the manifest once all of them exist.
+    """
+
+    logger = get_run_logger()
 
+    blobs = []
     for photo_metadata in response_json:
-        _upload_photo_metadata_as_blob.submit(
-            response, photo_metadata, gcp_credential_block_name, bucket_name
+        photo = _photo_metadata_record(response, photo_metadata)
+        blob_name = f"{photo['payload']['id']}.json"
+        blobs.append((blob_name, json.dumps(photo).encode("utf-8")))
+
+    logger.info(f"Uploading {len(blobs)} blobs to {bucket_name}")
+    result = bulk_upload_files_to_gcs_bucket(
+        gcp_credential_block_name, bucket_name, blobs, codec=codec
+    )
+    if len(result.failed) > 0:
+        # Retry the page, unchanged blobs aren't uploaded again
+        raise RuntimeError(f"Failed to upload {len(result.failed)} blobs")
+
+    if page is not None:
+        photo_ids = [photo_metadata["id"] for photo_metadata in response_json]
+        write_manifest(
+            bucket_name,
+            f"page-{page:07d}",
+            photo_ids,
+            [f"{photo_id}.json" for photo_id in photo_ids],
+            gcp_credential_block_name,
         )
 
 
+@task(retries=3, retry_delay_seconds=3)  # Task (2nd level)
+def upload_photo_metadata_as_shard(
+    response,
+    response_json: list[dict],
+    page: int,
+    gcp_credential_block_name: str,
+    bucket_name: str,
+    file_format: Literal["ndjson", "parquet"] = "ndjson",
+    codec: Literal["gzip", "zstd"] = None,
+) -> str:
+    """Upload the photo metadata of a page as one shard to Google Cloud Storage Bucket"""
+
+    logger = get_run_logger()
+
+    records = [
+        _photo_metadata_record(response, photo_metadata)
+        for photo_metadata in response_json
+    ]
+    photo_ids = [photo_metadata["id"] for photo_metadata in response_json]
+
+    blob_name = write_shard(
+        bucket_name,
+        f"page-{page:07d}",
+        records,
+        photo_ids,
+        gcp_credential_block_name,
+        file_format,
+        codec,
+    )
+    logger.info(f"Uploaded {len(records)} records as '{blob_name}' to {bucket_name}")
+
+    return blob_name
+
+
 @flow(
     retries=3,
     retry_delay_seconds=10,
@@ -123,77 +198,63 @@ def get_last_requested_page_from_logs(
     return last_requested_page
 
 
+# Schema of staged request log records (see `write_request_log_to_bigquery`)
+REQUEST_LOG_STAGING_SCHEMA = [
+    bigquery.SchemaField("request_id", "STRING"),
+    bigquery.SchemaField("request_url", "STRING"),
+    bigquery.SchemaField("requested_page", "INT64"),
+    bigquery.SchemaField("per_page", "INT64"),
+    bigquery.SchemaField("requested_at", "DATETIME"),
+]
+
+
 @flow(
     retries=3,
     retry_delay_seconds=10,
 )  # Subflow (2nd level)
 def write_request_log_to_bigquery(
     gcp_credentials: GcpCredentials,
-    request_id: str,
-    request_url: str,
-    params: dict,
+    records: list[dict],
     env: str = "dev",
     location="europe-west3",
 ):
-    """Write for which URLs metadata has been requested and stored in Google Cloud Storage"""
+    """Write for which URLs metadata has been requested and stored in Google Cloud Storage
 
-    logger = get_run_logger()
-    logger.info(f"Unsplash Request ID: {request_id}")
-
-    location = "europe-west3"
+    All records are applied with one `MERGE`: known request URLs get a new request id and
+    `last_requested_at`, new ones are inserted.
+    """
 
-    query = f"""
-        SELECT *
-            FROM `unsplash-photo-trends.{env}.photos-editorial-metadata-request-log`
-            WHERE request_url = @request_url
-        """
-
-    query_params = [("request_url", "STRING", request_url)]
-
-    row = bigquery_query(query, gcp_credentials, query_params, location=location)
-
-    if len(row) > 0:
-        query = f"""
-            UPDATE `unsplash-photo-trends.{env}.photos-editorial-metadata-request-log`
-            SET last_requested_at = CURRENT_DATETIME(), request_id = @request_id
-            WHERE request_url = @request_url
-        """
-
-        query_params = [
-            ("request_url", "STRING", request_url),
-            ("request_id", "STRING", request_id),
-        ]
-
-        bigquery_query(query, gcp_credentials, query_params, location=location)
-
-        logger.info(
-            f"Updated existing log entry for Request URL '{request_url}' in table `unsplash-photo-trends.{env}.photos-editorial-metadata-request-log`"
-        )
-
-    if len(row) == 0:
-        query = f"""
-            INSERT `unsplash-photo-trends.{env}.photos-editorial-metadata-request-log`
-            (request_id, request_url, requested_page, number_requested_objects_in_payload, first_requested_at, last_requested_at)
-            VALUES (@request_id, @request_url, @requested_page, @per_page, CURRENT_DATETIME(), CURRENT_DATETIME())
-        """
-
-        query_params = [
-            ("request_url", "STRING", request_url),
-            ("request_id", "STRING", request_id),
-            ("requested_page", "INT64", params["page"]),
-            ("per_page", "INT64", params["per_page"]),
-        ]
-
-        bigquery_query(query, gcp_credentials, query_params, location=location)
+    logger = get_run_logger()
 
-        logger.info(
-            f"Add new log entry for Request URL '{request_url}' in table `unsplash-photo-trends.{env}.photos-editorial-metadata-request-log`"
-        )
+    query = """
+        MERGE {target} AS T
+        USING (
+            SELECT *
+            FROM {staging}
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY request_url ORDER BY requested_at DESC) = 1
+        ) AS S
+        ON T.request_url = S.request_url
+        WHEN MATCHED THEN
+            UPDATE SET last_requested_at = S.requested_at, request_id = S.request_id
+        WHEN NOT MATCHED THEN
+            INSERT (request_id, request_url, requested_page, number_requested_objects_in_payload, first_requested_at, last_requested_at)
+            VALUES (S.request_id, S.request_url, S.requested_page, S.per_page, S.requested_at, S.requested_at)
+    """
+
+    bigquery_client = gcp_credentials.get_bigquery_client(location=location)
+    affected_rows = merge_rows(
+        bigquery_client,
+        env,
+        "photos-editorial-metadata-request-log",
+        records,
+        REQUEST_LOG_STAGING_SCHEMA,
+        query,
+    )
 
-    else:
-        raise ValueError(
-            f"{row} seems to be malformed. Can't insert or update logs based on this data"
-        )
+    logger.info(
+        f"Merged {len(records)} log entries ({affected_rows} rows affected) into table `unsplash-photo-trends.{env}.photos-editorial-metadata-request-log`"
+    )
 
 
 @flow  # Main Flow (1st level)
@@ -201,8 +262,34 @@ def ingest_photos_napi_gcs(
     gcp_credential_block_name: str,
     per_page: int,
     proxy_type: Literal["datacenter", "residential"],
+    concurrency: int = 5,
+    politeness_delay_seconds: float = 3,
+    storage_layout: Literal["shards", "blobs"] = "shards",
+    compression: Literal["gzip", "zstd"] = None,
+    max_images: int = 3000,
+    log_flush_pages: int = 100,
+    reconcile_interval_hours: float = 24,
 ):
-    """Flow to load Editorial photos from Unsplash and store them in a Google Cloud Storage Bucket"""
+    """Flow to load Editorial photos from Unsplash and store them in a Google Cloud Storage Bucket
+
+    Up to `concurrency` pages are requested at the same time (fewer if the process runs short of
+    file descriptors, see `src.network.descriptors`). Pages are processed (and logged) in order,
+    so the request log never skips a page. A run stops after `max_images` images (or at the last
+    page). The default keeps a run well within the interval of its schedule, so runs don't overlap
+    and overwrite each other's state. `max_images` None works through all remaining pages, e.g.
+    for a manual backfill.
+
+    Request log entries are buffered and merged into Bigquery every `log_flush_pages` pages and
+    at the end of the run. The last requested page is kept in a local state (see `src.etl.state`),
+    the request log is only read to reconcile it every `reconcile_interval_hours`.
+
+    With `storage_layout` "shards" the metadata of a page is stored as one NDJSON shard (see
+    `src.etl.shards`), with "blobs" as one JSON blob per photo.
+
+    With `compression` the metadata is stored compressed, with a matching `Content-Encoding`.
+    Objects stored with gzip stay readable by the external Bigquery table, zstd ones are only
+    decompressed by `src.etl.extract`.
+    """
 
     logger = get_run_logger()
 
@@ -214,6 +301,10 @@ def ingest_photos_napi_gcs(
     # Init all secrets and credentials
     gcp_credentials = GcpCredentials.load(gcp_credential_block_name)
 
+    # Allow as many open sockets as the system permits
+    descriptor_limit = raise_descriptor_limit()
+    logger.info(f"File descriptor limit: {descriptor_limit}")
+
     # Request first page
     first_page_response = request_first_page()
     number_requestable_objects = int(first_page_response.headers["X-Total"])
@@ -227,7 +318,15 @@ def ingest_photos_napi_gcs(
     logger.info(f"The endpoint contains: \n {pformat(log_dict)}")
 
     # Get last requested page from Unsplash photo endpoint
-    last_requested_page = get_last_requested_page_from_logs(gcp_credentials, env)
+    state = IngestionState.from_gcs_blob(
+        bucket_name, gcp_credential_block_name, STATE_BLOB_NAME
+    )
+    if state.needs_reconcile(
+        "pages", datetime.timedelta(hours=reconcile_interval_hours)
+    ):
+        state.reconcile_pages(get_last_requested_page_from_logs(gcp_credentials, env))
+        state.save()
+    last_requested_page = state.last_requested_page()
     logger.info(
         f"Last requested page in table 'unsplash-photo-trends.{env}.photos-editorial-metadata-request-log' from endpoint is '{last_requested_page}'"
     )
@@ -235,65 +334,118 @@ def ingest_photos_napi_gcs(
     # Counter
     next_page = last_requested_page + 1
     number_stored_images = 0
+    failed_attempts = 0
+    request_log_records = []
+
+    if max_images is None:
+        max_images = number_requestable_objects  # Work through all remaining pages
+
+    def flush_request_log():
+        """Merge buffered log records into Bigquery and remember their pages in the state"""
+        if len(request_log_records) == 0:
+            return
+        write_request_log_to_bigquery(gcp_credentials, request_log_records, env)
+        state.mark_page_requested(request_log_records[-1]["requested_page"])
+        state.save()
+        request_log_records.clear()
+
+    # Pages stored in GCS are logged even if the run fails (e.g. a page keeps failing)
+    try:
+        while next_page <= total_number_pages and number_stored_images < max_images:
+            # Request a window of pages concurrently (scaled to the file descriptors left)
+            remaining_pages_in_run = math.ceil(
+                (max_images - number_stored_images) / per_page
+            )
+            window_size = min(
+                descriptor_limiter.scale(concurrency),
+                total_number_pages - next_page + 1,
+                remaining_pages_in_run,
+            )
+            pages = list(range(next_page, next_page + window_size))
 
-    while next_page <= total_number_pages:
-        # Init Params
-        params = {}
-        params["per_page"] = per_page
-        params["page"] = next_page
-        params["order_by"] = "oldest"
-
-        sleep_time_seconds = randint(1, 3)
-        logger.info(f"Sleeping for {sleep_time_seconds} seconds")
-        time.sleep(randint(1, 3))
-
-        # Prepare Proxy and Useragent
-        proxies = prepare_proxy_adresses(proxy_type)
-        useragent_string = create_random_ua_string()
-        logger.info(f"Will be using '{useragent_string}' to make next requests")
-        headers = {"User-Agent": useragent_string}  # Overwrite Useragent
-
-        # Actually request the data
-        logger.info("Request data of interest")
-        response = request_unsplash_api(
-            endpoint="/photos",
-            proxies=proxies,
-            headers=headers,
-            params=params,
-            base_url="https://unsplash.com/napi",
-        )
-        logger.info(f"Request headers: \n {pformat(dict(response.request.headers))}")
-        logger.info(f"Response headers: \n {pformat(dict(response.headers))}")
-
-        response_json = parse_response(response)
-
-        # Asychronously collect data
-        upload_photo_metadata_to_gcs(
-            response, response_json, gcp_credential_block_name, bucket_name
-        )
-        logger.info(
-            f"Uploaded {len(response_json)} blobs to Google Cloud Storage Bucket: {bucket_name}"
-        )
-
-        number_stored_images += params["per_page"]
-        logger.info(
-            f"Number of stored images in this data collection run: {number_stored_images}"
-        )
-
-        request_id = response.headers["X-Request-Id"]
-        request_url = response.request.url
-        write_request_log_to_bigquery(
-            gcp_credentials, request_id, request_url, params, env
-        )
-
-        # Break the Loop if 300 images have been collected to avoid "OSError: [Errno 24] Too many open files"
-        if number_stored_images == 300:
-            logger.info(
-                "Downloaded metadata for 300 Editorial images of Unsplash platform"
+            logger.info(f"Request data of interest (pages {pages[0]} to {pages[-1]})")
+            responses = request_pages(
+                pages, per_page, proxy_type, politeness_delay_seconds
             )
-            break
 
-        next_page += 1
+            # Process pages in order, a failed page is requested again in the next window
+            for page, response in zip(pages, responses):
+                if isinstance(response, BaseException):
+                    logger.warning(f"Requesting page {page} failed: {response}")
+                    break
+
+                params = {}
+                params["per_page"] = per_page
+                params["page"] = page
+                params["order_by"] = "oldest"
+
+                logger.info(
+                    f"Request headers: \n {pformat(dict(response.request.headers))}"
+                )
+                logger.info(f"Response headers: \n {pformat(dict(response.headers))}")
+
+                response_json = parse_response(response)
+
+                if storage_layout == "shards":
+                    upload_photo_metadata_as_shard(
+                        response,
+                        response_json,
+                        page,
+                        gcp_credential_block_name,
+                        bucket_name,
+                        codec=compression,
+                    )
+                else:
+                    # Asychronously collect data
+                    upload_photo_metadata_to_gcs(
+                        response,
+                        response_json,
+                        gcp_credential_block_name,
+                        bucket_name,
+                        page,
+                        compression,
+                    )
+                logger.info(
+                    f"Uploaded metadata of {len(response_json)} photos to Google Cloud Storage Bucket: {bucket_name}"
+                )
+
+                number_stored_images += params["per_page"]
+                logger.info(
+                    f"Number of stored images in this data collection run: {number_stored_images}"
+                )
+
+                request_log_records.append(
+                    {
+                        "request_id": response.headers["X-Request-Id"],
+                        "request_url": str(response.request.url),
+                        "requested_page": params["page"],
+                        "per_page": params["per_page"],
+                        "requested_at": datetime.datetime.utcnow().isoformat(),
+                    }
+                )
+
+                next_page += 1
+
+            if len(request_log_records) >= log_flush_pages:
+                flush_request_log()
+
+            # Give up if the next page fails repeatedly
+            if next_page == pages[0]:
+                failed_attempts += 1
+                if failed_attempts == 3:
+                    raise RuntimeError(f"Requesting page {next_page} failed 3 times")
+            else:
+                failed_attempts = 0
+    finally:
+        flush_request_log()
+
+    close_http_clients()
+    logger.info(f"Uploads of single blobs: {upload_stats.metrics()}")
+    logger.info(f"File descriptors: {descriptor_limiter.metrics()}")
+
+    logger.info(
+        f"Downloaded metadata for {number_stored_images} Editorial images of Unsplash platform"
+    )
 
 
 if __name__ == "__main__":
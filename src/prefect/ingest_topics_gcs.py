@@ -1,6 +1,7 @@
 """ Flow to request https://api.unsplash.com/topics/ Endpoint """
 
-from prefect import flow
+from prefect import flow, get_run_logger
+from src.network.conditional import ResponseValidatorCache
 from src.prefect.generic_tasks import (
     parse_response,
     request_unsplash_api,
@@ -10,14 +11,14 @@ from src.prefect.generic_tasks import (
 from src.utils import load_env_variables, timer
 
 
-# Subflow
-@flow(retries=3, retry_delay_seconds=10)
+# Subflow (requests are retried by `request_unsplash_api`)
+@flow
 @timer
-def request_topics() -> list[dict]:
+def request_topics(headers: dict = None) -> list[dict]:
     """Request topics (= photography genres which have a seperate content site on unsplash) from Unsplash API"""
 
     endpoint = "/topics/"
-    response = request_unsplash_api(endpoint=endpoint)
+    response = request_unsplash_api(endpoint=endpoint, headers=headers)
 
     return response
 
@@ -25,17 +26,36 @@ def request_topics() -> list[dict]:
 @flow
 @timer
 def ingest_topics_gcs():
-    """Flow to load topics from Unsplash and store them in a Google Cloud Storage Bucket"""
+    """Flow to load topics from Unsplash and store them in a Google Cloud Storage Bucket
+
+    Topics are only stored if they changed since the last run (conditional request).
+    """
     # Call the function with the directory you want to start from
 
-    response = request_topics()
-    response_json = parse_response(response)
+    logger = get_run_logger()
+
     env_variables = load_env_variables()
     env = env_variables["ENV"]  # dev, test or prod
 
+    validator_cache = ResponseValidatorCache.from_gcs_blob(
+        bucket_name=f"unsplash-topics-{env}",
+        blob_name="_response_validators.json",
+        gcp_credential_block_name="unsplash-photo-trends-deployment-sa",
+    )
+
+    response = request_topics(headers=validator_cache.request_headers("topics"))
+    if validator_cache.is_unchanged("topics", response):
+        logger.info("Topics didn't change since last run. Nothing to store")
+        return
+
+    response_json = parse_response(response)
+
     df = response_data_to_df(response_json, "topics")
     store_response_df_to_gcs_bucket(df, "topics", env)
 
+    validator_cache.update("topics", response)
+    validator_cache.save()
+
 
 if __name__ == "__main__":
     ingest_topics_gcs()
@@ -1,10 +1,16 @@
 """ Sync Google Cloud Storage (JSONL) with Bigquery. PUSH Pattern that needs to be setup just for once for each Bigquery Table """
 
+import fnmatch
+from typing import Literal
+
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 from prefect_gcp import GcpCredentials
 
 from prefect import flow, get_run_logger, task
+from src.etl.bigquery_jobs import load_uris
+from src.etl.extract import list_blob_names
+from src.etl.state import IngestionState
 from src.utils import timer
 
 
@@ -86,6 +92,72 @@ def sync_gcs_and_bigquery_table(
     logger.info(f"Synced Bigquery table '{table}' with '{source_uri}'")
 
 
+@task
+@timer
+def load_new_gcs_files_into_bigquery_table(
+    bigquery_client: bigquery.client.Client,
+    table_name: str,
+    source_uri: str,
+    autodetect: bool,
+    env: str = "dev",
+    file_format: str = "PARQUET",
+    partition_field: str = None,
+    clustering_fields: list[str] = None,
+    projection: str = None,
+    gcp_credential_block_name: str = "unsplash-photo-trends-deployment-sa",
+):
+    """Load files of Google Cloud Storage which haven't been loaded yet into a native Bigquery table
+
+    Files matching `source_uri` (e.g. "gs://photos-editorial-metadata-dev/shards/*.json") are
+    appended with load jobs. Loaded files are kept in a state next to them (see `src.etl.state`),
+    so every run only loads new files. A `projection` (`SELECT` list, e.g.
+    `src.etl.shards.SHARD_PROJECTION`) selects the columns which are loaded.
+    """
+    logger = get_run_logger()
+
+    bucket_name, pattern = source_uri.removeprefix("gs://").split("/", 1)
+    prefix = pattern.split("*")[0].split("?")[0].split("[")[0]
+
+    blob_names = list_blob_names(
+        bucket_name,
+        gcp_credential_block_name,
+        prefixes=[prefix] if prefix else None,
+    )
+    blob_names = [name for name in blob_names if fnmatch.fnmatchcase(name, pattern)]
+
+    state = IngestionState.from_gcs_blob(
+        bucket_name,
+        gcp_credential_block_name,
+        f"state/sync-{env}-{table_name}.sqlite.gz",
+    )
+    stage = f"sync-{table_name}"
+    new_blob_names = state.pending(stage, blob_names)
+    logger.info(
+        f"{len(new_blob_names)} of {len(blob_names)} files matching '{source_uri}' haven't been loaded yet"
+    )
+
+    if len(new_blob_names) == 0:
+        return
+
+    loaded_rows = load_uris(
+        bigquery_client,
+        env,
+        table_name,
+        [f"gs://{bucket_name}/{name}" for name in new_blob_names],
+        file_format,
+        autodetect,
+        partition_field,
+        clustering_fields,
+        projection,
+    )
+    state.mark_processed(stage, new_blob_names)
+    state.save()
+
+    logger.info(
+        f"Loaded {loaded_rows} rows of {len(new_blob_names)} files into Bigquery table '{table_name}'"
+    )
+
+
 @flow
 @timer
 def sync_gcs_to_bigquery(
@@ -94,19 +166,47 @@ def sync_gcs_to_bigquery(
     autodetect: bool,
     file_format: str,
     env: str = "dev",
+    mode: Literal["external", "native"] = "external",
+    partition_field: str = None,
+    clustering_fields: list[str] = None,
+    projection: str = None,
 ):
-    """Sync Google Cloud Storage with Bigquery Table using Push pattern"""
+    """Sync Google Cloud Storage with Bigquery Table using Push pattern
+
+    With `mode` "external" the table reads the files on every query. With "native" the files are
+    loaded into a table partitioned by month of `partition_field` and clustered by
+    `clustering_fields`, so queries filtering on them only scan matching partitions and blocks.
+    Every run of "native" loads only the files added since the last run.
+
+    Both have to be top level columns: topics and stats files can be partitioned by
+    "requested_data_at" as they are. Photo metadata shards keep the request time and photo id in
+    nested fields, which `projection=SHARD_PROJECTION` (see `src.etl.shards`) lifts to
+    "requested_at" and "photo_id".
+    """
 
     bigquery_client = construct_bigquery_client()
     create_dataset(bigquery_client, env)
-    sync_gcs_and_bigquery_table(
-        bigquery_client,
-        table_name,
-        source_uri,
-        autodetect,
-        env,
-        file_format,
-    )
+    if mode == "external":
+        sync_gcs_and_bigquery_table(
+            bigquery_client,
+            table_name,
+            source_uri,
+            autodetect,
+            env,
+            file_format,
+        )
+    else:
+        load_new_gcs_files_into_bigquery_table(
+            bigquery_client,
+            table_name,
+            source_uri,
+            autodetect,
+            env,
+            file_format,
+            partition_field,
+            clustering_fields,
+            projection,
+        )
 
 
 if __name__ == "__main__":
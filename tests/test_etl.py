@@ -0,0 +1,706 @@
+import datetime
+import io
+import json
+import sqlite3
+import types
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import BadRequest, Conflict
+from google.cloud import bigquery, storage
+
+from src.etl import (
+    bigquery_jobs,
+    clients,
+    extract,
+    index,
+    load,
+    shards,
+    state,
+    transform,
+)
+
+
+class FakeGcpCredentials:
+    loads = 0
+
+    @classmethod
+    def load(cls, name):
+        cls.loads += 1
+        return cls()
+
+    def get_cloud_storage_client(self):
+        return storage.Client.create_anonymous_client()
+
+
+def test_storage_client_and_buckets_are_cached(monkeypatch):
+    monkeypatch.setattr(clients, "GcpCredentials", FakeGcpCredentials)
+    clients.clear_clients()
+
+    buckets = [
+        clients.get_bucket("photos-editorial-metadata-dev", "test-block")
+        for _ in range(300)
+    ]
+
+    assert FakeGcpCredentials.loads == 1
+    assert all(bucket is buckets[0] for bucket in buckets)
+    assert clients.get_bucket("photos-editorial-dev", "test-block") is not buckets[0]
+
+    clients.clear_clients()
+
+
+def test_serialize_shard_as_ndjson_and_parquet():
+    records = [
+        {"payload": {"id": "hwUxEG1dTig", "likes": 167}},
+        {"payload": {"id": "_UrvVQh5cyo", "likes": 12}},
+    ]
+
+    lines = shards.serialize_shard(records, "ndjson").decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == records
+
+    table = pq.read_table(io.BytesIO(shards.serialize_shard(records, "parquet")))
+    assert table.to_pylist() == records
+
+
+def test_shard_layout_is_distinguishable_from_photo_blobs():
+    assert shards.shard_blob_name("page-0000001") == "shards/page-0000001.json"
+    assert shards.is_photo_blob("hwUxEG1dTig.json")
+    assert not shards.is_photo_blob("shards/page-0000001.json")
+    assert not shards.is_photo_blob("manifest/page-0000001.csv")
+
+
+class FakeBlob:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeBlobIterator:
+    def __init__(self, names, page_size):
+        self.pages = [
+            [FakeBlob(name) for name in names[i : i + page_size]]
+            for i in range(0, len(names), page_size)
+        ]
+
+
+class FakeStorageClient:
+    def __init__(self, names):
+        self.names = names
+        self.requested_fields = set()
+
+    def list_blobs(self, bucket_name, prefix, delimiter, page_size, fields):
+        self.requested_fields.add(fields)
+        names = [
+            n
+            for n in self.names
+            if n.startswith(prefix) and "/" not in n[len(prefix) :]
+        ]
+        return FakeBlobIterator(names, page_size)
+
+
+def test_list_blob_names_lists_prefixes_concurrently(monkeypatch):
+    names = [f"{c}photo{i}.json" for c in extract.ID_ALPHABET for i in range(5)]
+    storage_client = FakeStorageClient(names + ["shards/page-0000001.json"])
+    monkeypatch.setattr(extract, "get_storage_client", lambda _: storage_client)
+
+    listed = list(
+        extract.list_blob_names("bucket", "test-block", delimiter="/", page_size=2)
+    )
+
+    assert sorted(listed) == sorted(names)
+    assert storage_client.requested_fields == {"items(name),nextPageToken,prefixes"}
+
+
+def test_photo_id_index_only_reads_manifests_after_watermark(monkeypatch, tmp_path):
+    manifests = {
+        "manifest/page-0000001.csv": {"a": "shards/page-0000001.json"},
+        "manifest/page-0000002.csv": {"b": "shards/page-0000002.json"},
+    }
+    listed_offsets = []
+
+    def list_manifest_blob_names(bucket_name, block_name, start_offset=None):
+        listed_offsets.append(start_offset)
+        return [name for name in sorted(manifests) if name >= (start_offset or "")]
+
+    def read_manifests(bucket_name, blob_names, block_name):
+        return {k: v for name in blob_names for k, v in manifests[name].items()}
+
+    monkeypatch.setattr(
+        index, "list_blob_names", lambda *args, **kwargs: iter(["legacy.json"])
+    )
+    monkeypatch.setattr(index, "list_manifest_blob_names", list_manifest_blob_names)
+    monkeypatch.setattr(index, "read_manifests", read_manifests)
+
+    photo_id_index = index.PhotoIdIndex.from_file(tmp_path / "index.json.gz")
+    assert not photo_id_index.exists
+    assert photo_id_index.update_from_bucket("bucket", "test-block") == 3
+    photo_id_index.save()
+
+    manifests["manifest/page-0000003.csv"] = {"c": "shards/page-0000003.json"}
+    photo_id_index = index.PhotoIdIndex.from_file(tmp_path / "index.json.gz")
+    assert photo_id_index.update_from_bucket("bucket", "test-block") == 1
+
+    assert listed_offsets == [None, "manifest/page-0000002.csv"]
+    assert photo_id_index.manifest_watermark == "manifest/page-0000003.csv"
+    assert photo_id_index.known == {"a", "b", "c", "legacy"}
+
+
+def test_ingestion_state_is_snapshotted_and_reconciled(tmp_path):
+    ingestion_state = state.IngestionState.from_file(tmp_path / "state.sqlite.gz")
+    assert not ingestion_state.exists
+    assert ingestion_state.last_requested_page() == 0
+    assert ingestion_state.needs_reconcile("metadata", datetime.timedelta(hours=24))
+
+    ingestion_state.reconcile_processed("metadata", ["a", "b"])
+    ingestion_state.mark_processed("metadata", ["c"])
+    ingestion_state.mark_processed("download", ["a"])
+    ingestion_state.mark_page_requested(42)
+    ingestion_state.mark_page_requested(41)
+    ingestion_state.save()
+
+    ingestion_state = state.IngestionState.from_file(tmp_path / "state.sqlite.gz")
+    assert ingestion_state.exists
+    assert ingestion_state.last_requested_page() == 42
+    assert ingestion_state.is_processed("metadata", "c")
+    assert not ingestion_state.is_processed("download", "b")
+    assert ingestion_state.pending("metadata", ["a", "d", "c", "e"]) == ["d", "e"]
+    assert not ingestion_state.needs_reconcile("metadata", datetime.timedelta(hours=24))
+    assert ingestion_state.needs_reconcile("metadata", datetime.timedelta(0))
+    assert ingestion_state.needs_reconcile("pages", datetime.timedelta(hours=24))
+
+    # Bigquery is the source of truth
+    ingestion_state.reconcile_processed("metadata", ["a"])
+    ingestion_state.reconcile_pages(40)
+    assert ingestion_state.processed("metadata") == {"a"}
+    assert ingestion_state.processed("download") == {"a"}
+    assert ingestion_state.last_requested_page() == 40
+
+
+class Python310Connection(sqlite3.Connection):
+    """Connection without `serialize` and `deserialize`, which Python 3.10 doesn't have"""
+
+    def __getattribute__(self, name):
+        if name in ("serialize", "deserialize"):
+            raise AttributeError(name)
+        return super().__getattribute__(name)
+
+
+def test_ingestion_state_snapshot_works_on_python_310(monkeypatch, tmp_path):
+    connect = sqlite3.connect
+    monkeypatch.setattr(
+        sqlite3,
+        "connect",
+        lambda *args, **kwargs: connect(*args, factory=Python310Connection, **kwargs),
+    )
+
+    ingestion_state = state.IngestionState.from_file(tmp_path / "state.sqlite.gz")
+    ingestion_state.mark_processed("download", ["a"])
+    ingestion_state.mark_page_requested(7)
+    ingestion_state.save()
+
+    ingestion_state = state.IngestionState.from_file(tmp_path / "state.sqlite.gz")
+    assert ingestion_state.processed("download") == {"a"}
+    assert ingestion_state.last_requested_page() == 7
+
+
+class FakeStoredBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.crc32c = None
+        self.generation = None
+
+    def upload_from_string(self, contents, if_generation_match, checksum, **kwargs):
+        assert if_generation_match == (self.bucket.generation(self.name) or 0)
+        self.crc32c = load.crc32c_checksum(contents)
+        self.generation = (self.bucket.generation(self.name) or 0) + 1
+        self.bucket.blobs[self.name] = self
+
+
+class FakeBucket:
+    def __init__(self):
+        self.blobs = {}
+
+    def generation(self, name):
+        return self.blobs[name].generation if name in self.blobs else None
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def blob(self, name):
+        return FakeStoredBlob(self, name)
+
+
+def test_upload_is_skipped_if_checksum_is_unchanged(monkeypatch):
+    bucket = FakeBucket()
+    monkeypatch.setattr(load, "get_bucket", lambda *args: bucket)
+    monkeypatch.setattr(load, "upload_stats", load.UploadStats())
+
+    uploads = [
+        load.upload_blob_from_memory_if_changed("bucket", contents, "a.jpg", "block")[1]
+        for contents in [b"photo", b"photo", b"edited photo"]
+    ]
+
+    assert uploads == [True, False, True]
+    assert bucket.blobs["a.jpg"].generation == 2
+    assert load.upload_stats.metrics() == {
+        "uploaded": 2,
+        "skipped": 1,
+        "bytes_uploaded": 17,
+        "bytes_saved": 5,
+    }
+
+
+def test_compressed_contents_are_deterministic_and_decompressed():
+    contents = json.dumps([{"payload": {"id": "hwUxEG1dTig", "likes": 167}}] * 100)
+    contents = contents.encode("utf-8")
+
+    compressed = load.compress(contents, "gzip")
+
+    assert compressed == load.compress(contents, "gzip")
+    assert len(compressed) < len(contents) / 5
+    assert extract.decompress(compressed, "gzip") == contents
+    assert extract.decompress(load.compress(contents, "zstd"), "zstd") == contents
+    assert extract.decompress(contents, None) == contents
+
+
+class FakeBlobWriter(io.BytesIO):
+    def __init__(self, blob):
+        super().__init__()
+        self.blob = blob
+
+    def close(self):
+        self.blob.contents = self.getvalue()
+        super().close()
+
+
+class FakeWritableBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.contents = None
+
+    def open(self, mode, **kwargs):
+        return FakeBlobWriter(self)
+
+    def delete(self):
+        del self.bucket.blobs[self.name]
+
+
+class FakeWritableBucket:
+    def __init__(self):
+        self.blobs = {}
+
+    def blob(self, name):
+        return self.blobs.setdefault(name, FakeWritableBlob(self, name))
+
+    def rename_blob(self, blob, new_name):
+        self.blobs[new_name] = self.blobs.pop(blob.name)
+        self.blobs[new_name].name = new_name
+        return self.blobs[new_name]
+
+
+def test_failed_stream_does_not_create_a_blob(monkeypatch):
+    bucket = FakeWritableBucket()
+    monkeypatch.setattr(load, "get_bucket", lambda *args: bucket)
+
+    def chunks(fail: bool):
+        yield b"\xff\xd8"
+        if fail:
+            raise ConnectionError("Connection reset by peer")
+        yield b"\xff\xd9"
+
+    try:
+        load.upload_blob_from_stream("bucket", chunks(fail=True), "a.jpg", "block")
+        assert False, "The failed stream should raise"
+    except ConnectionError:
+        pass
+    assert bucket.blobs == {}  # The truncated upload isn't committed
+
+    load.upload_blob_from_stream("bucket", chunks(fail=False), "a.jpg", "block")
+    assert list(bucket.blobs) == ["a.jpg"]
+    assert bucket.blobs["a.jpg"].contents == b"\xff\xd8\xff\xd9"
+
+
+def test_dataframe_is_written_as_parquet_in_memory_and_streamed(monkeypatch):
+    bucket = FakeWritableBucket()
+    monkeypatch.setattr(load, "get_bucket", lambda *args: bucket)
+    df = pd.DataFrame({"photo_id": [f"id-{i}" for i in range(1000)], "likes": 1})
+
+    parquet_file = pq.ParquetFile(
+        io.BytesIO(load.dataframe_to_parquet(df, "zstd", row_group_size=100))
+    )
+    assert parquet_file.metadata.num_row_groups == 10
+    assert parquet_file.read().to_pandas().equals(df)
+
+    load.upload_dataframe_as_parquet(
+        "bucket", df, "stats.parquet", "block", row_group_size=250, stream=True
+    )
+    parquet_file = pq.ParquetFile(io.BytesIO(bucket.blobs["stats.parquet"].contents))
+    assert parquet_file.metadata.num_row_groups == 4
+    assert parquet_file.read().to_pandas().equals(df)
+
+
+def test_failed_parquet_stream_does_not_create_a_blob(monkeypatch):
+    bucket = FakeWritableBucket()
+    monkeypatch.setattr(load, "get_bucket", lambda *args: bucket)
+    df = pd.DataFrame({"photo_id": [f"id-{i}" for i in range(1000)], "likes": 1})
+
+    slices = []
+
+    class FailingTable:
+        @staticmethod
+        def from_pandas(df, **kwargs):
+            slices.append(len(df))
+            if len(slices) == 3:
+                raise MemoryError()
+            return pa.Table.from_pandas(df, **kwargs)
+
+    monkeypatch.setattr(
+        load, "pa", types.SimpleNamespace(Schema=pa.Schema, Table=FailingTable)
+    )
+
+    try:
+        load.upload_dataframe_as_parquet(
+            "bucket", df, "stats.parquet", "block", row_group_size=250, stream=True
+        )
+        assert False, "The failed conversion should raise"
+    except MemoryError:
+        pass
+    assert slices == [250, 250, 250]  # Converted one row group at a time
+    assert bucket.blobs == {}
+
+
+def test_records_to_df_infers_types_like_read_json():
+    records = [
+        {"id": "3bnm95isIxE", "links": {"html": "https://unsplash.com/t/a"}},
+        {"id": "bo8jQKTaE0Y", "links": {"html": "https://unsplash.com/t/b"}},
+    ]
+    for record, ends_at in zip(records, ["2023-09-30T23:59:59Z", None]):
+        record.update(ends_at=ends_at, only_submissions_after=None)
+
+    df = transform.records_to_df(records)
+    assert str(df["ends_at"].dtype) == "datetime64[ns, UTC]"
+    assert df["only_submissions_after"].dtype == "float64"
+    assert df["links"][0] == {"html": "https://unsplash.com/t/a"}
+
+    # Date-like columns without any value (e.g. ongoing topics) stay dates
+    df = transform.records_to_df([{**record, "ends_at": None} for record in records])
+    assert str(df["ends_at"].dtype) == "datetime64[ns]"
+
+    df = transform.records_to_df(records, flatten=True)
+    assert list(df["links_html"]) == [
+        "https://unsplash.com/t/a",
+        "https://unsplash.com/t/b",
+    ]
+
+    schema = pa.schema([("id", pa.string()), ("ends_at", pa.timestamp("s", "UTC"))])
+    df = transform.records_to_df(
+        [{"id": "3bnm95isIxE", "ends_at": datetime.datetime(2023, 9, 30)}], schema
+    )
+    assert list(df.columns) == ["id", "ends_at"]
+
+
+def test_bulk_upload_reports_uploaded_skipped_and_failed_blobs(monkeypatch):
+    bucket = FakeBucket()
+    monkeypatch.setattr(load, "get_bucket", lambda *args: bucket)
+    load.upload_blob_from_memory_if_changed("bucket", b"photo", "a.json", "block")
+
+    def get_blob(name):
+        if name == "broken.json":
+            raise ConnectionError("Connection reset by peer")
+        return bucket.blobs.get(name)
+
+    monkeypatch.setattr(bucket, "get_blob", get_blob)
+    blobs = [(f"{i}.json", b"photo") for i in range(100)]
+    blobs += [("a.json", b"photo"), ("broken.json", b"photo")]
+
+    result = load.upload_blobs_from_memory("bucket", blobs, "block", max_workers=4)
+
+    assert len(result.uploaded) == 100
+    assert result.skipped == ["a.json"]
+    assert list(result.failed) == ["broken.json"]
+    assert len(result.stored) == 101
+
+
+class FakeJob:
+    num_dml_affected_rows = 2
+
+    def __init__(self, output_rows=None, record_batches=(), error_result=None):
+        self.output_rows = output_rows
+        self.record_batches = record_batches
+        self.error_result = error_result
+
+    def result(self, **kwargs):
+        if self.error_result is not None:
+            raise BadRequest(self.error_result["message"])
+        return self
+
+    def to_arrow_iterable(self, bqstorage_client, max_queue_size):
+        return iter(self.record_batches)
+
+
+class FakeBigqueryClient:
+    project = "unsplash-photo-trends"
+
+    def __init__(self, record_batches=()):
+        self.calls = []
+        self.jobs = {}
+        self.record_batches = record_batches
+        self.failing_loads = 0
+
+    def create_table(self, table):
+        self.calls.append(("create_table", table.table_id, table.expires is not None))
+
+    def get_table(self, table_id):
+        self.calls.append(("get_table", table_id))
+        return bigquery.Table(
+            table_id, schema=[bigquery.SchemaField("photo_id", "STRING")]
+        )
+
+    def load_table_from_json(self, rows, table_id, job_config, job_id=None):
+        if job_id in self.jobs:
+            raise Conflict(f"Already Exists: Job {job_id}")
+        self.calls.append(("load", rows, job_config.write_disposition))
+        job = FakeJob(output_rows=len(rows))
+        if self.failing_loads > 0:
+            self.failing_loads -= 1
+            job.error_result = {"reason": "invalid", "message": "No such field"}
+        if job_id is not None:
+            self.jobs[job_id] = job
+        return job
+
+    def load_table_from_uri(self, uris, table_id, job_config, job_id=None):
+        if job_id in self.jobs:
+            raise Conflict(f"Already Exists: Job {job_id}")
+        self.calls.append(("load_uris", uris, job_config))
+        job = FakeJob(output_rows=10 * len(uris))
+        if job_id is not None:
+            self.jobs[job_id] = job
+        return job
+
+    def update_table(self, table, fields):
+        self.calls.append(("update_table", table.table_id, fields))
+
+    def get_job(self, job_id):
+        self.calls.append(("get_job", job_id))
+        return self.jobs[job_id]
+
+    def query(self, query, job_config=None, job_id=None):
+        if job_id in self.jobs:
+            raise Conflict(f"Already Exists: Job {job_id}")
+        self.calls.append(("query", query))
+        job = FakeJob(record_batches=self.record_batches)
+        if job_id is not None:
+            self.jobs[job_id] = job
+        return job
+
+    def delete_table(self, table_id, not_found_ok):
+        self.calls.append(("delete_table", table_id))
+
+
+def test_merge_rows_stages_rows_and_applies_them_with_one_merge():
+    bigquery_client = FakeBigqueryClient()
+    rows = [
+        {"request_url": f"https://unsplash.com/napi/photos?page={i}"} for i in range(3)
+    ]
+
+    affected_rows = bigquery_jobs.merge_rows(
+        bigquery_client,
+        "dev",
+        "photos-editorial-metadata-request-log",
+        rows,
+        [bigquery.SchemaField("request_url", "STRING")],
+        "MERGE {target} AS T USING {staging} AS S ON T.request_url = S.request_url",
+    )
+
+    assert affected_rows == 2
+    assert [call[0] for call in bigquery_client.calls] == [
+        "create_table",
+        "load",
+        "query",
+        "delete_table",
+    ]
+    staging_table = bigquery_client.calls[0][1]
+    assert staging_table.startswith("photos-editorial-metadata-request-log-staging-")
+    assert bigquery_client.calls[0][2]  # Expires
+    assert bigquery_client.calls[1][1] == rows
+    assert (
+        "MERGE `unsplash-photo-trends.dev.photos-editorial-metadata-request-log` AS T "
+        f"USING `unsplash-photo-trends.dev.{staging_table}`"
+        in bigquery_client.calls[2][1]
+    )
+
+
+def test_load_rows_loads_a_batch_exactly_once():
+    bigquery_client = FakeBigqueryClient()
+    rows = [{"photo_id": f"photo-{i}"} for i in range(3)]
+
+    loaded_rows = bigquery_jobs.load_rows(
+        bigquery_client, "dev", "photos-editorial-download-log", rows
+    )
+    retried_rows = bigquery_jobs.load_rows(
+        bigquery_client, "dev", "photos-editorial-download-log", rows
+    )
+
+    assert loaded_rows == retried_rows == 3
+    assert [call[0] for call in bigquery_client.calls] == [
+        "get_table",
+        "load",
+        "get_table",
+        "get_job",
+    ]
+    assert bigquery_client.calls[1][2] == bigquery.WriteDisposition.WRITE_APPEND
+    assert bigquery_jobs.load_job_id(
+        "photos-editorial-download-log", rows
+    ) != bigquery_jobs.load_job_id("photos-editorial-download-log", rows[:2])
+
+
+def test_load_rows_submits_a_batch_again_after_a_failed_load():
+    bigquery_client = FakeBigqueryClient()
+    bigquery_client.failing_loads = 1
+    rows = [{"photo_id": f"photo-{i}"} for i in range(3)]
+
+    def load_rows():
+        return bigquery_jobs.load_rows(
+            bigquery_client, "dev", "photos-editorial-download-log", rows
+        )
+
+    try:
+        load_rows()
+        assert False, "The failed load job should raise"
+    except BadRequest:
+        pass
+    assert load_rows() == 3  # Submitted again under the next job id
+    assert load_rows() == 3  # Not loaded a third time
+
+    assert [call[0] for call in bigquery_client.calls if call[0] != "get_table"] == [
+        "load",
+        "get_job",
+        "load",
+        "get_job",
+        "get_job",
+    ]
+    job_id = bigquery_jobs.load_job_id("photos-editorial-download-log", rows)
+    assert sorted(bigquery_client.jobs) == [job_id, f"{job_id}-1"]
+
+
+def test_load_uris_appends_files_to_a_partitioned_clustered_table(monkeypatch):
+    monkeypatch.setattr(bigquery_jobs, "MAX_URIS_PER_LOAD_JOB", 2)
+    bigquery_client = FakeBigqueryClient()
+    uris = [f"gs://unsplash-topics-dev/topics-{i}.parquet" for i in range(3)]
+
+    def load_uris():
+        return bigquery_jobs.load_uris(
+            bigquery_client,
+            "dev",
+            "unsplash-topics",
+            uris,
+            partition_field="requested_data_at",
+            clustering_fields=["slug"],
+        )
+
+    assert load_uris() == 30
+    assert load_uris() == 30  # Retried, files aren't appended twice
+    assert [call[1] for call in bigquery_client.calls[:2]] == [uris[:2], uris[2:]]
+    assert [call[0] for call in bigquery_client.calls[2:]] == ["get_job", "get_job"]
+    job_config = bigquery_client.calls[0][2]
+    assert job_config.time_partitioning.type_ == bigquery.TimePartitioningType.MONTH
+    assert job_config.time_partitioning.field == "requested_data_at"
+    assert job_config.clustering_fields == ["slug"]
+    assert job_config.write_disposition == bigquery.WriteDisposition.WRITE_APPEND
+
+
+def test_load_uris_projects_nested_shard_fields_into_top_level_columns():
+    bigquery_client = FakeBigqueryClient()
+    uris = [
+        f"gs://photos-editorial-metadata-dev/shards/page-{i}.json" for i in range(3)
+    ]
+
+    def load_uris():
+        return bigquery_jobs.load_uris(
+            bigquery_client,
+            "dev",
+            "photos-editorial-metadata",
+            uris,
+            "NEWLINE_DELIMITED_JSON",
+            partition_field="requested_at",
+            clustering_fields=["photo_id"],
+            projection=shards.SHARD_PROJECTION,
+        )
+
+    assert load_uris() == 2
+    assert load_uris() == 2  # Retried, the staged rows aren't inserted twice
+
+    calls = bigquery_client.calls
+    assert [call[0] for call in calls[:6]] == [
+        "load_uris",
+        "get_table",
+        "update_table",
+        "query",
+        "query",
+        "delete_table",
+    ]
+    staging_table_id = calls[1][1]
+    assert staging_table_id.startswith(
+        "unsplash-photo-trends.dev.photos-editorial-metadata-staging-"
+    )
+    assert calls[0][1] == uris
+    assert calls[2][2] == ["expires"]  # Expires
+    create_query = " ".join(calls[3][1].split())
+    assert create_query.startswith(
+        "CREATE TABLE IF NOT EXISTS `unsplash-photo-trends.dev.photos-editorial-metadata` "
+        "PARTITION BY TIMESTAMP_TRUNC(requested_at, MONTH) CLUSTER BY photo_id AS SELECT"
+    )
+    assert "payload.id AS photo_id" in calls[4][1]
+    assert calls[4][1].startswith(
+        "INSERT INTO `unsplash-photo-trends.dev.photos-editorial-metadata` SELECT"
+    )
+    assert calls[4][1].endswith(f"FROM `{staging_table_id}`")
+    assert calls[5][1] == staging_table_id
+    assert [call[0] for call in calls[6:]] == [
+        "load_uris",
+        "get_table",
+        "update_table",
+        "query",
+        "get_job",
+        "delete_table",
+    ]
+
+
+def test_pending_work_query_anti_joins_orders_and_limits_in_bigquery():
+    query = extract.pending_work_query(
+        "unsplash-photo-trends.dev.photos-editorial-metadata-expanded",
+        "unsplash-photo-trends.dev.photos-editorial-download-log",
+        "photo_id",
+        ["photo_id", "urls.full", "created_at"],
+        order_by="created_at",
+    )
+    query = " ".join(query.split())
+
+    assert query.startswith("SELECT photo_id, urls.full, created_at FROM")
+    assert "WHERE NOT EXISTS" in query
+    assert "processed.photo_id = source.photo_id" in query
+    assert query.endswith("ORDER BY created_at LIMIT @limit")
+
+
+def test_query_record_batches_streams_arrow_record_batches():
+    record_batches = [
+        pa.record_batch(
+            [pa.array([f"photo-{i}", f"photo-{i + 1}"]), pa.array([i, i + 1])],
+            names=["photo_id", "likes"],
+        )
+        for i in (0, 2)
+    ]
+    bigquery_client = FakeBigqueryClient(record_batches)
+
+    batches = extract.query_record_batches(
+        bigquery_client,
+        "SELECT photo_id, likes FROM photos LIMIT @limit",
+        [bigquery.ScalarQueryParameter("limit", "INT64", 4)],
+    )
+
+    assert [batch.num_rows for batch in batches] == [2, 2]
+    assert bigquery_client.calls == [
+        ("query", "SELECT photo_id, likes FROM photos LIMIT @limit")
+    ]
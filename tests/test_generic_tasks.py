@@ -1,3 +1,4 @@
+import io
 import json
 
 import pandas as pd
@@ -5,13 +6,17 @@ import requests
 from google.cloud import storage
 
 from prefect.logging import disable_run_logger
+from src.etl.load import UploadStats
+from src.prefect import generic_tasks
 from src.prefect.generic_tasks import (
+    bulk_stream_files_to_gcs_bucket,
     create_random_ua_string,
     parse_response,
     prepare_proxy_adresses,
     request_unsplash_api,
     response_data_to_df,
     store_response_df_to_gcs_bucket,
+    stream_file_to_gcs_bucket,
 )
 
 
@@ -22,6 +27,86 @@ def test_create_random_ua_string_successful():
         assert len(random_ua_string) > 0
 
 
+class FakeStoredPhoto:
+    size = 3_000_000
+
+
+class FakePhotoBucket:
+    def get_blob(self, name):
+        return FakeStoredPhoto() if name == "2023-9/stored.jpg" else None
+
+
+def test_stream_file_to_gcs_bucket_skips_stored_photos(monkeypatch):
+    monkeypatch.setattr(generic_tasks, "get_bucket", lambda *args: FakePhotoBucket())
+    monkeypatch.setattr(generic_tasks, "upload_stats", UploadStats())
+
+    def get(*args, **kwargs):
+        raise AssertionError("Stored photos must not be downloaded again")
+
+    monkeypatch.setattr(generic_tasks.requests, "get", get)
+
+    with disable_run_logger():
+        blob_name, response = stream_file_to_gcs_bucket.fn(
+            "block", "photos-editorial-dev", "/photo-1", "stored", "jpg", "2023-9"
+        )
+
+    assert (blob_name, response) == ("2023-9/stored.jpg", None)
+    assert generic_tasks.upload_stats.metrics()["bytes_saved"] == 3_000_000
+
+
+class FakeSession:
+    def __init__(self):
+        self.urls = []
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        response = requests.Response()
+        response.status_code = 404 if url.endswith("missing") else 200
+        response.raw = io.BytesIO(b"\xff\xd8\xff\xd9")
+        return response
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_bulk_stream_files_to_gcs_bucket_streams_a_batch_in_one_task(monkeypatch):
+    session = FakeSession()
+    uploads = {}
+
+    def upload_blob_from_stream(bucket_name, chunks, blob_name, *args, **kwargs):
+        uploads[blob_name] = b"".join(chunks)
+        return storage.Blob(blob_name, None)
+
+    monkeypatch.setattr(generic_tasks, "get_bucket", lambda *args: FakePhotoBucket())
+    monkeypatch.setattr(generic_tasks.requests, "Session", lambda: session)
+    monkeypatch.setattr(
+        generic_tasks, "upload_blob_from_stream", upload_blob_from_stream
+    )
+
+    files = [
+        ("/photo-1", "2023-9/new.jpg"),
+        ("/photo-2", "2023-9/stored.jpg"),
+        ("/missing", "2023-9/missing.jpg"),
+    ]
+    with disable_run_logger():
+        responses = bulk_stream_files_to_gcs_bucket.fn("block", "photos", files)
+
+    assert list(responses) == ["2023-9/new.jpg", "2023-9/stored.jpg"]
+    assert responses["2023-9/new.jpg"].status_code == 200
+    assert responses["2023-9/stored.jpg"] is None  # Not downloaded again
+    assert uploads == {"2023-9/new.jpg": b"\xff\xd8\xff\xd9"}
+    assert sorted(session.urls) == [
+        "https://images.unsplash.com/missing",
+        "https://images.unsplash.com/photo-1",
+    ]
+
+
 def test_prepare_bright_data_proxies_successful():
     with disable_run_logger():
         proxies = prepare_proxy_adresses.fn(proxy_type="residential")
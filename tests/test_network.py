@@ -0,0 +1,292 @@
+import asyncio
+import io
+import time
+
+import requests
+
+from src.network import descriptors
+from src.network.clients import AsyncClientRegistry, ClientLoop
+from src.network.conditional import ResponseValidatorCache
+from src.network.hedging import RequestHedger
+from src.network.proxies import ProxySessionPool
+from src.network.rate_limit import RateLimitGovernor
+from src.network.retry import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    get_circuit_breaker,
+    parse_retry_after,
+    send_with_retry,
+    send_with_retry_async,
+)
+from src.network.useragents import UserAgentPool
+
+
+def test_async_client_registry_reuses_client_per_proxy_session():
+    registry = AsyncClientRegistry()
+    proxies_a = {"http://": "http://user-session-1:pw@host:22225"}
+    proxies_b = {"http://": "http://user-session-2:pw@host:22225"}
+
+    async def main():
+        client = registry.get(proxies_a)
+        assert registry.get(dict(proxies_a)) is client
+        assert registry.get(proxies_b) is not client
+        await registry.aclose()
+        assert client.is_closed
+
+    asyncio.run(main())
+
+
+def test_client_loop_shares_clients_across_event_loops():
+    registry = AsyncClientRegistry()
+    loop = ClientLoop()
+
+    async def get_client():
+        async def get():
+            return registry.get()
+
+        return await loop.run(get())
+
+    # Like Prefect, which runs each async task in an event loop of its own
+    first_client = asyncio.run(get_client())
+    second_client = asyncio.run(get_client())
+    assert first_client is second_client
+
+    asyncio.run(loop.run(registry.aclose()))
+    assert first_client.is_closed
+    assert registry._clients == {}
+
+
+def test_rate_limit_governor_is_unlimited_without_headers():
+    governor = RateLimitGovernor()
+    assert governor.update_from_headers({}) is False
+    assert all(governor.acquire() == 0 for _ in range(100))
+
+
+def test_rate_limit_governor_paces_requests_near_exhausted_quota():
+    governor = RateLimitGovernor(window_seconds=3600, reserve_ratio=0.1)
+    governor.update_from_headers(
+        {"X-Ratelimit-Limit": "50", "X-Ratelimit-Remaining": "7"}
+    )
+
+    # 7 remaining - 5 reserved = 2 tokens, the third request has to wait for a refill
+    assert governor._reserve() == 0
+    assert governor._reserve() == 0
+    assert governor._reserve() > 60
+
+    metrics = governor.metrics()
+    assert metrics["waits"] == 1
+    assert metrics["refill_rate_per_second"] == 50 / 3600
+
+
+def test_proxy_session_pool_evicts_failing_sessions(monkeypatch):
+    monkeypatch.setattr(
+        "src.network.proxies.load_proxy_credentials", lambda _: ("user", "pw")
+    )
+    pool = ProxySessionPool(size=2, min_requests=2, max_error_rate=0.3)
+
+    session = pool.get("residential")
+    proxies = session.proxies(httpx_format=True)
+    assert "-session-" in proxies["https://"]
+
+    pool.record(proxies, 0.5, success=False)
+    pool.record(proxies, 0.5, success=False)
+
+    assert session not in pool.sessions("residential")
+    assert len(pool.sessions("residential")) == 2
+    assert pool.evictions == 1
+
+    # The evicted session is forgotten, but requests still holding it can be hedged
+    assert pool.lookup(proxies) is None
+    assert len(pool._sessions_by_url) == 2
+    assert pool.proxy_type(proxies) == "residential"
+
+
+def test_proxy_session_pool_prefers_faster_sessions(monkeypatch):
+    monkeypatch.setattr(
+        "src.network.proxies.load_proxy_credentials", lambda _: ("user", "pw")
+    )
+    pool = ProxySessionPool(size=2)
+    pool.get("datacenter")
+    slow, fast = pool.sessions("datacenter")
+
+    pool.record(slow.proxies(), 3.0, success=True)
+    pool.record(fast.proxies(), 0.2, success=True)
+
+    picks = [pool.get("datacenter") for _ in range(1000)]
+
+    assert picks.count(fast) > 800
+    assert picks.count(slow) > 0
+
+
+def test_useragent_pool_is_built_once():
+    pool = UserAgentPool()
+    useragents = {pool.random() for _ in range(200)}
+    built_at = pool._built_at
+
+    assert all("Mozilla/5.0" in useragent for useragent in useragents)
+    assert len(useragents) > 1
+    assert pool.random() and pool._built_at == built_at
+
+
+def test_response_validator_cache_detects_unchanged_responses(tmp_path):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'[{"id": "3bnm95isIxE"}]'
+    response.headers = {"ETag": 'W/"abc"'}
+
+    cache = ResponseValidatorCache.from_file(tmp_path / "validators.json")
+    assert cache.request_headers("topics") == {}
+    assert not cache.is_unchanged("topics", response)
+
+    cache.update("topics", response)
+    cache.save()
+
+    cache = ResponseValidatorCache.from_file(tmp_path / "validators.json")
+    assert cache.request_headers("topics") == {"If-None-Match": 'W/"abc"'}
+    assert cache.is_unchanged("topics", response)
+
+    not_modified = requests.Response()
+    not_modified.status_code = 304
+    assert cache.is_unchanged("topics", not_modified)
+
+
+def _response(status_code: int, headers: dict = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.raw = io.BytesIO(b"")
+    return response
+
+
+def test_send_with_retry_retries_retryable_errors_only():
+    policy = RetryPolicy(max_attempts=3, base_delay_seconds=0, max_delay_seconds=0)
+
+    responses = iter(
+        [_response(503), _response(429, {"Retry-After": "0"}), _response(200)]
+    )
+    response = send_with_retry(lambda: next(responses), "retry-test-1", policy=policy)
+    assert response.status_code == 200
+
+    responses = iter([_response(404), _response(200)])
+    response = send_with_retry(lambda: next(responses), "retry-test-2", policy=policy)
+    assert response.status_code == 404
+
+
+def test_retry_policy_honours_retry_after_and_jitters_backoff():
+    policy = RetryPolicy(base_delay_seconds=1, max_delay_seconds=30)
+    assert policy.delay(attempt=1, retry_after=12) == 12
+    assert 0 <= policy.delay(attempt=3) <= 4
+    assert parse_retry_after("7") == 7
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout_seconds=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_half_open_trial_is_released_if_the_attempt_does_not_complete():
+    host_breaker = get_circuit_breaker("host:cancel-test")
+    proxy_breaker = get_circuit_breaker("proxy:cancel-test")
+    for breaker in (host_breaker, proxy_breaker):
+        breaker.reset_timeout_seconds = 0
+        breaker.opened_at = 0  # Half open
+
+    async def hanging_send():
+        await asyncio.sleep(5)
+
+    async def main():
+        attempt = asyncio.create_task(
+            send_with_retry_async(hanging_send, "cancel-test", "cancel-test")
+        )
+        await asyncio.sleep(0.01)
+        attempt.cancel()
+        try:
+            await attempt
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    assert host_breaker.state == "half_open"
+    assert host_breaker.allow()
+    host_breaker.release_trial()
+
+    # The host trial isn't consumed if the proxy circuit is open
+    proxy_breaker.reset_timeout_seconds = 60
+    proxy_breaker.opened_at = time.monotonic()
+    try:
+        send_with_retry(lambda: None, "cancel-test", "cancel-test")
+    except CircuitOpenError:
+        pass
+    assert host_breaker.allow()
+
+
+def test_request_hedger_returns_first_response_and_cancels_loser():
+    hedger = RequestHedger(min_samples=1, min_delay_seconds=0.01)
+    hedger.latencies.record(0.01)
+    primary_cancelled = asyncio.Event()
+
+    async def slow_primary():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            primary_cancelled.set()
+            raise
+        return "primary"
+
+    async def fast_backup():
+        return "backup"
+
+    async def main():
+        result = await hedger.run(slow_primary, fast_backup, budget_ratio=1.0)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == "backup"
+    assert primary_cancelled.is_set()
+    assert hedger.metrics()["hedges_won"] == 1
+
+
+def test_request_hedger_respects_budget():
+    hedger = RequestHedger(min_samples=1, min_delay_seconds=0.01)
+    hedger.latencies.record(0.01)
+
+    async def slow_primary():
+        await asyncio.sleep(0.05)
+        return "primary"
+
+    async def fast_backup():
+        return "backup"
+
+    result = asyncio.run(hedger.run(slow_primary, fast_backup, budget_ratio=0.0))
+    assert result == "primary"
+    assert hedger.hedges == 0
+
+
+def test_descriptor_limiter_scales_to_descriptors_left(monkeypatch):
+    limiter = descriptors.DescriptorLimiter(descriptors_per_slot=2, reserve_ratio=0.25)
+    monkeypatch.setattr(descriptors.resource, "getrlimit", lambda _: (100, 100))
+    # Each request in flight holds 2 descriptors
+    monkeypatch.setattr(
+        descriptors, "open_descriptor_count", lambda: 35 + 2 * limiter.in_flight
+    )
+
+    # (100 * 0.75 - 35) / 2 = 20 slots
+    assert limiter.capacity() == 20
+    assert limiter.scale(50) == 20
+    assert limiter.scale(5) == 5
+
+    async def request(i):
+        async with limiter.slot_async():
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*[request(i) for i in range(100)])
+
+    asyncio.run(main())
+    assert limiter.peak_in_flight == 20
+    assert limiter.in_flight == 0